@@ -1,9 +1,11 @@
+from threading import Thread
 from flask import Flask
 from flask_smorest import Api
-from redis import Redis
 from flask_session.redis import RedisSessionInterface
 
-from config import APP_HOST, REDIS_SERVER_HOST, REDIS_SERVER_PORT, APIConfig
+from config import APP_HOST, MODEL_WARMUP, APIConfig
+from redis_store import redis
+from child_api.readiness import mark_ready, warmup_models
 from child_api.routes import child_bp
 from parent_api.routes import parent_bp
 from common_api.routes import common_bp, common_habitual_bp, common_learning_bp
@@ -12,7 +14,6 @@ app = Flask(__name__)
 
 app.config.from_object(APIConfig)
 
-redis = Redis(host=REDIS_SERVER_HOST, port=REDIS_SERVER_PORT)
 app.session_interface = RedisSessionInterface(app, client=redis)
 
 api = Api(app)
@@ -22,6 +23,14 @@ api.register_blueprint(common_bp)
 api.register_blueprint(common_habitual_bp)
 api.register_blueprint(common_learning_bp)
 
+# Warming up the models, /common/ready reports when it is done
+if MODEL_WARMUP == "blocking":
+    warmup_models()
+elif MODEL_WARMUP == "background":
+    Thread(target=warmup_models, name="warmup", daemon=True).start()
+else:
+    mark_ready()
+
 
 if __name__ == "__main__":
     app.run(host=APP_HOST, debug=True, threaded = True)
@@ -0,0 +1,133 @@
+import io
+import wave
+from math import gcd
+
+import numpy as np
+import soundfile
+from scipy.io import wavfile
+from scipy.signal import resample_poly
+
+# Rate expected by the SER model and used for Chirp
+TARGET_SAMPLE_RATE = 16000
+
+# Containers Chirp can take as uploaded, without converting to LINEAR16
+SPEECH_NATIVE_FORMATS = {"flac": "FLAC", "ogg_opus": "OGG_OPUS"}
+
+
+class DecodedAudio:
+    """ An uploaded clip decoded once per request.
+
+        Holds the clip as 16kHz mono float32 samples in [-1, 1], which are
+        handed as is to the SER model. Chirp gets mono FLAC and Opus uploads 
+        as they are and everything else (stereo included) as LINEAR16 """
+
+    def __init__(self, samples: np.ndarray, duration: float, source_sample_rate: int,
+                 source_format: str = "wav", source_bytes: bytes | None = None,
+                 source_channels: int = 1):
+        self.samples = samples
+        self.duration = duration
+        self.source_sample_rate = source_sample_rate
+        self.source_format = source_format
+        self.source_bytes = source_bytes
+        self.source_channels = source_channels
+        self.sample_rate = TARGET_SAMPLE_RATE
+        self._linear16 = None
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "DecodedAudio":
+        """ Decodes a WAV, FLAC or OGG (Opus / Vorbis) upload """
+        source_format = detect_format(data)
+        if source_format == "wav":
+            return cls.from_wav_bytes(data)
+        if source_format is None:
+            raise ValueError("Unsupported audio format, expected WAV, FLAC or OGG")
+
+        samples, sample_rate = soundfile.read(io.BytesIO(data), dtype="float32")
+        duration = len(samples) / sample_rate
+        channels = samples.shape[1] if samples.ndim == 2 else 1
+        if samples.ndim == 2: #if Dual Audio then convert to Mono
+            samples = samples.mean(axis=1)
+        samples = resample(samples, sample_rate, TARGET_SAMPLE_RATE)
+        return cls(samples, duration, sample_rate, source_format, data, channels)
+
+    @classmethod
+    def from_wav_bytes(cls, data: bytes) -> "DecodedAudio":
+        duration = wav_header_duration(data)
+        sample_rate, pcm = wavfile.read(io.BytesIO(data))
+        if duration is None:
+            duration = len(pcm) / sample_rate
+
+        samples = to_float32(pcm)
+        if samples.ndim == 2: #if Dual Audio then convert to Mono
+            samples = samples.mean(axis=1)
+        samples = resample(samples, sample_rate, TARGET_SAMPLE_RATE)
+        return cls(samples, duration, sample_rate)
+
+    @property
+    def linear16(self) -> bytes:
+        """ Headerless 16 bit PCM of the samples, as sent to Chirp """
+        if self._linear16 is None:
+            self._linear16 = (np.clip(self.samples, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+        return self._linear16
+
+    def speech_input(self):
+        """ (content, encoding, sample rate) of the audio sent to Chirp. The 
+            recognition config has no channel count, so multi channel uploads
+            are sent as the decoded mono samples """
+        if self.source_format in SPEECH_NATIVE_FORMATS and self.source_channels == 1:
+            return self.source_bytes, SPEECH_NATIVE_FORMATS[self.source_format], self.source_sample_rate
+        return self.linear16, "LINEAR16", self.sample_rate
+
+    def ser_input(self, start: int = 0, length: int | None = None, min_samples: int = 0):
+        """ Input format of the HF audio pipeline for a window of the clip, 
+            no decoding or resampling needed. The window is a view of the 
+            samples, copied only when zero padded to min_samples """
+        end = len(self.samples) if length is None else start + length
+        return {"raw": pad_samples(self.samples[start:end], min_samples), 
+                "sampling_rate": self.sample_rate}
+
+
+def detect_format(data: bytes):
+    """ Container of the audio from its magic bytes: wav, flac, ogg_opus, ogg or None """
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        return "wav"
+    if data[:4] == b"fLaC":
+        return "flac"
+    if data[:4] == b"OggS":
+        # The first page carries the codec identification header
+        return "ogg_opus" if b"OpusHead" in data[:64] else "ogg"
+    return None
+
+def wav_header_duration(data: bytes):
+    """ Duration from the WAV header without reading the samples, None if
+        the header is not plain PCM """
+    try:
+        with wave.open(io.BytesIO(data)) as wav:
+            return wav.getnframes() / wav.getframerate()
+    except (wave.Error, EOFError):
+        return None
+
+def to_float32(pcm: np.ndarray) -> np.ndarray:
+    """ Scales integer PCM to float32 in [-1, 1] """
+    if pcm.dtype == np.uint8:
+        return (pcm.astype(np.float32) - 128) / 128
+    if np.issubdtype(pcm.dtype, np.integer):
+        return pcm.astype(np.float32) / np.iinfo(pcm.dtype).max
+    return pcm.astype(np.float32)
+
+def resample(samples: np.ndarray, from_rate: int, to_rate: int) -> np.ndarray:
+    """ Polyphase resampling of the whole clip in one vectorized call """
+    if from_rate == to_rate:
+        return samples.astype(np.float32, copy=False)
+    divisor = gcd(from_rate, to_rate)
+    return resample_poly(samples, to_rate // divisor, from_rate // divisor).astype(np.float32)
+
+def pad_samples(samples: np.ndarray, min_samples: int) -> np.ndarray:
+    """ Zero pads samples at the end to at least min_samples """
+    if len(samples) >= min_samples:
+        return samples
+    return np.pad(samples, (0, min_samples - len(samples)))
+
+def encoded_duration(data: bytes):
+    """ Duration of compressed audio (MP3, OGG, FLAC) from its stream info """
+    return soundfile.info(io.BytesIO(data)).duration
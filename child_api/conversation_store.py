@@ -0,0 +1,77 @@
+import json
+from typing import List, Optional
+
+from config import CONVERSATION_TTL_SECONDS
+from redis_store import redis
+
+# -----------------------------------------------------------------
+# State of an ongoing voice chat, kept out of the session blob so a
+# request only reads and appends what it needs.
+#   conv:<id>:turns     list of JSON chat history entries (persona first)
+#   conv:<id>:emotions  list of the emotion detected in every prompt
+#   conv:<id>:duration  total seconds of audio, incremented every turn
+#   conv:<id>:summary   running summary of the turns folded away
+# Every key expires CONVERSATION_TTL_SECONDS after the last turn.
+# -----------------------------------------------------------------
+
+def turns_key(conversation_id: str):
+    return f"conv:{conversation_id}:turns"
+
+def emotions_key(conversation_id: str):
+    return f"conv:{conversation_id}:emotions"
+
+def duration_key(conversation_id: str):
+    return f"conv:{conversation_id}:duration"
+
+def summary_key(conversation_id: str):
+    return f"conv:{conversation_id}:summary"
+
+def all_keys(conversation_id: str):
+    return [turns_key(conversation_id), emotions_key(conversation_id),
+            duration_key(conversation_id), summary_key(conversation_id)]
+
+
+def load_history(conversation_id: str):
+    """ Chat history and running summary, the only state a turn reads """
+    pipe = redis.pipeline(transaction=False)
+    pipe.lrange(turns_key(conversation_id), 0, -1)
+    pipe.get(summary_key(conversation_id))
+    turns, summary = pipe.execute()
+    return [json.loads(turn) for turn in turns], summary.decode() if summary else None
+
+def append_turn(conversation_id: str, entries: List[dict], emotion: str, duration: float):
+    """ Appends the new history entries, the emotion and the audio duration of a turn """
+    pipe = redis.pipeline()
+    if entries:
+        pipe.rpush(turns_key(conversation_id), *[json.dumps(entry) for entry in entries])
+    pipe.rpush(emotions_key(conversation_id), emotion)
+    pipe.incrbyfloat(duration_key(conversation_id), duration)
+    for key in all_keys(conversation_id):
+        pipe.expire(key, CONVERSATION_TTL_SECONDS)
+    pipe.execute()
+
+def drop_turns(conversation_id: str, persona: List[dict], count: int, summary: str):
+    """ Replaces the `count` oldest entries after the persona by the running summary """
+    pipe = redis.pipeline()
+    pipe.ltrim(turns_key(conversation_id), len(persona) + count, -1)
+    if persona:
+        pipe.lpush(turns_key(conversation_id), *[json.dumps(entry) for entry in reversed(persona)])
+    pipe.set(summary_key(conversation_id), summary, ex=CONVERSATION_TTL_SECONDS)
+    pipe.execute()
+
+def load_conversation(conversation_id: str):
+    """ Everything saved at the end of a chat: (history, emotions, duration, summary) """
+    pipe = redis.pipeline(transaction=False)
+    pipe.lrange(turns_key(conversation_id), 0, -1)
+    pipe.lrange(emotions_key(conversation_id), 0, -1)
+    pipe.get(duration_key(conversation_id))
+    pipe.get(summary_key(conversation_id))
+    turns, emotions, duration, summary = pipe.execute()
+    return ([json.loads(turn) for turn in turns],
+            [emotion.decode() for emotion in emotions],
+            float(duration) if duration else None,
+            summary.decode() if summary else None)
+
+def delete_conversation(conversation_id: Optional[str]):
+    if conversation_id:
+        redis.delete(*all_keys(conversation_id))
@@ -0,0 +1,161 @@
+import json
+import os
+import time
+from typing import Iterator, List, Optional
+
+import google.generativeai as genai
+
+from child_api.providers import get_client, record_call, track_call
+from config import (GEMINI_SESSION_CACHE_BYTES, GEMINI_SESSION_CACHE_ENABLED, 
+                    GEMINI_SESSION_CACHE_ITEMS, GEMINI_SESSION_CACHE_TTL_SECONDS)
+from lru import LRUCache
+
+
+# ----------------------------------------------------------------------
+# GOOGLE GEMINI Model
+# ----------------------------------------------------------------------
+
+gemini_context = "You are Aasha, an AI psychiatrist designed to support neurodivergent children aged 5-15. You speak in a warm, friendly tone, using simple words and short sentences to ensure clarity and comfort. Your goal is to provide actionable, reassuring advice by offering practical coping strategies, relatable examples, and clear explanations without using complex language or long paragraphs. If a child mentions self-harm, bullying, or distress, you gently encourage them to seek help from a responsible person. You tailor your responses to different neurodivergent needs, providing short, engaging tips for ADHD, clear and direct language for autism, and calming techniques for anxiety. You should not special characters like *, #, or emojis and ensure all messages are easy to read and formatted in plain text. Limit to 50 words"
+
+def add_persona(chat_history: list, emotion:str|None):
+    """ Inserts the persona at the start of a new chat history """
+    persona = gemini_context
+    if emotion and len(emotion) > 0:
+        persona += " The user has a small chance of being " + emotion
+
+    # Insert system instruction at the beginning of history if provided
+    if persona and len(chat_history)==0:
+        chat_history.insert(0, {"role": "model", "parts": persona})
+
+def log_prompt_tokens(response):
+    """ Logs the prompt size Gemini reports, to follow how it grows over a chat """
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        print("Gemini prompt tokens: ", usage.prompt_token_count)
+
+# ----------------------------------------------------------------------
+# Live chat sessions of ongoing voice chats, keyed by conversation id.
+# A cached session already holds the history, so a turn only sends the
+# new message. It is reused only while its history matches the stored
+# one, a compacted history or another worker's turn rebuilds it. A turn
+# takes the session out of the cache and puts it back once answered, so
+# two concurrent turns never share one.
+# ----------------------------------------------------------------------
+
+def create_session_cache():
+    # conversation id -> (chat session, history signature, history bytes)
+    return LRUCache(max_items=GEMINI_SESSION_CACHE_ITEMS,
+                    max_size=GEMINI_SESSION_CACHE_BYTES,
+                    ttl=GEMINI_SESSION_CACHE_TTL_SECONDS,
+                    sizeof=lambda entry: entry[2])
+
+chat_sessions = create_session_cache()
+
+def reset_after_fork():
+    """ Sessions hold the parent's gRPC channel, a forked worker starts empty """
+    global chat_sessions
+    chat_sessions = create_session_cache()
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+def history_signature(chat_history: List[dict]):
+    """ Cheap fingerprint of a history: its length, persona, oldest message and 
+        last entry. A history trimmed or compacted at the start no longer 
+        matches, even when it is back to the same length """
+    if not chat_history:
+        return (0, None, None, None)
+    oldest = chat_history[1]["parts"] if len(chat_history) > 1 else None
+    return (len(chat_history), hash(chat_history[0]["parts"]), hash(oldest), hash(chat_history[-1]["parts"]))
+
+def history_bytes(chat_history: List[dict]):
+    return sum(len(entry["parts"]) for entry in chat_history)
+
+def start_chat_session(chat_history: list, conversation_id: Optional[str]):
+    """ Cached chat session of the conversation if it holds exactly this history,
+        else a new one started from it """
+    if conversation_id and GEMINI_SESSION_CACHE_ENABLED:
+        # A session built from another history is dropped and counts as a miss
+        signature = history_signature(chat_history)
+        entry = chat_sessions.take(conversation_id, lambda entry: entry[1] == signature)
+        if entry is not None:
+            return entry[0]
+    return get_client("gemini").start_chat(history = chat_history)
+
+def keep_chat_session(conversation_id: Optional[str], chat_session, chat_history: list, prompt: str, reply: str):
+    """ Caches a chat session which just answered prompt with reply """
+    if conversation_id and GEMINI_SESSION_CACHE_ENABLED:
+        new_history = chat_history + [{"role": "user", "parts": prompt}, {"role": "model", "parts": reply}]
+        chat_sessions.set(conversation_id, (chat_session, history_signature(new_history), history_bytes(new_history)))
+
+def drop_chat_session(conversation_id: Optional[str]):
+    """ Forgets the cached session of a finished conversation """
+    if conversation_id:
+        chat_sessions.pop(conversation_id)
+
+def get_session_cache_stats():
+    """ Hit rate, evictions and memory (history bytes) of the chat session cache """
+    return {"enabled": GEMINI_SESSION_CACHE_ENABLED, **chat_sessions.stats()}
+
+def call_gemini(prompt: str, chat_history: list, emotion:str|None, conversation_id: Optional[str] = None):
+    """ Used for calling Gemini with a prompt. With a conversation id the chat 
+        session is kept for the next turn of that conversation """
+    add_persona(chat_history, emotion)
+
+    chat_session = start_chat_session(chat_history, conversation_id)
+    with track_call("gemini"):
+        response = chat_session.send_message(prompt)
+    log_prompt_tokens(response)
+    keep_chat_session(conversation_id, chat_session, chat_history, prompt, response.text)
+    return response.text
+
+def call_gemini_plain(prompt: str):
+    """ Used for one-off Gemini calls (summaries, narratives) which must not 
+        be answered in character by the child facing persona """
+    with track_call("gemini"):
+        response = get_client("gemini").generate_content(prompt)
+    log_prompt_tokens(response)
+    return response.text
+
+def stream_message(chat_session, prompt: str, call_name: str) -> Iterator[str]:
+    """ Sends prompt to a chat session, yielding the reply text as it arrives.
+        Only the time spent waiting on Gemini is recorded as a call to 
+        call_name, not the time the consumer takes between chunks (TTS, 
+        sending audio or events to the client) """
+    start = time.perf_counter()
+    response = chat_session.send_message(prompt, stream=True)
+    chunks = iter(response)
+    elapsed = time.perf_counter() - start
+    while True:
+        start = time.perf_counter()
+        chunk = next(chunks, None)
+        elapsed += time.perf_counter() - start
+        if chunk is None:
+            break
+        yield chunk.text
+    record_call(call_name, elapsed)
+    log_prompt_tokens(response)
+
+def call_gemini_stream(prompt: str, chat_history: list, emotion:str|None, 
+                       conversation_id: Optional[str] = None) -> Iterator[str]:
+    """ Used for calling Gemini with a prompt, yielding the reply text as it arrives """
+    add_persona(chat_history, emotion)
+
+    chat_session = start_chat_session(chat_history, conversation_id)
+    reply_chunks = []
+    for text in stream_message(chat_session, prompt, "gemini_stream"):
+        reply_chunks.append(text)
+        yield text
+    keep_chat_session(conversation_id, chat_session, chat_history, prompt, "".join(reply_chunks))
+
+def call_gemini_json(prompt: str, chat_history: list, response_schema: dict):
+    """ Used for calling Gemini with a prompt, constraining the reply to 
+        a JSON response_schema. Returns the parsed reply """
+    model = get_client("gemini")
+    generation_config = genai.GenerationConfig(
+        response_mime_type="application/json",
+        response_schema=response_schema
+    )
+    chat_session = model.start_chat(history = chat_history)
+    with track_call("gemini"):
+        response = chat_session.send_message(prompt, generation_config=generation_config)
+    return json.loads(response.text)
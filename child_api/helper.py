@@ -1,125 +1,254 @@
-import google.generativeai as genai
-from google.cloud import speech_v1 as speech
-from google.cloud import texttospeech
-from config import GEMINI_API_KEY
+import io
+import re
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 from scipy.io import wavfile
-from transformers import pipeline
-
-from config import GCP_KEY
-
-
-# ----------------------------------------------------------------------
-# GOOGLE GEMINI Model
-# ----------------------------------------------------------------------
-
-gemini_context = "You are Aasha, an AI psychiatrist designed to support neurodivergent children aged 5-15. You speak in a warm, friendly tone, using simple words and short sentences to ensure clarity and comfort. Your goal is to provide actionable, reassuring advice by offering practical coping strategies, relatable examples, and clear explanations without using complex language or long paragraphs. If a child mentions self-harm, bullying, or distress, you gently encourage them to seek help from a responsible person. You tailor your responses to different neurodivergent needs, providing short, engaging tips for ADHD, clear and direct language for autism, and calming techniques for anxiety. You should not special characters like *, #, or emojis and ensure all messages are easy to read and formatted in plain text. Limit to 50 words"
-
-def call_gemini(prompt: str, chat_history: list, emotion:str|None):
-    """ Used for calling Gemini with a prompt"""
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel(
-        model_name="gemini-1.5-flash"
-    )
-    global gemini_context
-    if emotion and len(emotion) > 0:
-        gemini_context+= " The user has a small chance of being " + emotion
-
-    # Insert system instruction at the beginning of history if provided
-    if gemini_context and len(chat_history)==0:
-        chat_history.insert(0, {"role": "model", "parts": gemini_context})
-
-    chat_session = model.start_chat(history = chat_history)
-    response = chat_session.send_message(prompt)
-    return response.text
 
+from child_api.providers import get_client, track_call
+from child_api import tts_cache
+from child_api.audio import DecodedAudio, encoded_duration, wav_header_duration
+from child_api.ser_backends import load_backend
+from child_api.ser_batcher import SERBatcher
+from config import SER_BACKEND, SER_BATCHING_ENABLED, SER_MAX_BATCH_SIZE, SER_MAX_WAIT_MS, SER_MIN_WINDOW_SECONDS, SER_WINDOW_HOP_SECONDS, SER_WINDOW_SECONDS, SER_WINDOWING_ENABLED, STREAM_MIN_CHUNK_CHARS, TTS_CACHE_ENABLED, VOICE_STAGE_WORKERS
 
 # ----------------------------------------------------------------------
 # GOOGLE Chirp Model
 # ----------------------------------------------------------------------
 
-def call_chirp(input_file: str):
+def call_chirp(decoded: DecodedAudio):
     """ Calling Google Chirp to convert audio to text """
-    sample_rate = convert_to_mono(input_file, "temp.wav")
-    client = speech.SpeechClient.from_service_account_file(GCP_KEY) #Requires Service Account
-
-    with open("temp.wav", 'rb') as audio_file:
-        # Making the parameters
-        content = audio_file.read()
-        audio = speech.RecognitionAudio(content=content)
-        config = speech.RecognitionConfig(
-                encoding = speech.RecognitionConfig.AudioEncoding.LINEAR16,
-                sample_rate_hertz = sample_rate,
-                language_code = 'en-US'
-                )
-        # Making a request to Recognize text in Audio
+    from google.cloud import speech_v1 as speech
+    client = get_client("speech") #Requires Service Account
+
+    # Making the parameters
+    content, encoding, sample_rate = decoded.speech_input()
+    audio = speech.RecognitionAudio(content=content)
+    config = speech.RecognitionConfig(
+            encoding = speech.RecognitionConfig.AudioEncoding[encoding],
+            sample_rate_hertz = sample_rate,
+            language_code = 'en-US'
+            )
+    # Making a request to Recognize text in Audio
+    with track_call("speech"):
         response = client.recognize(config = config, audio = audio)
-        # print(response)
-        try:
-            return response.results[0].alternatives[0].transcript
-        except Exception as e:
-            return "Chirp Model Failed to recognize Text from Speech" + str(e)
+    # print(response)
+    try:
+        return response.results[0].alternatives[0].transcript
+    except Exception as e:
+        return "Chirp Model Failed to recognize Text from Speech" + str(e)
 
 # ----------------------------------------------------------------------
 # GOOGLE TTS Model
 # ----------------------------------------------------------------------
 
-def call_tts(text: str, output_file: str):
-    """ Calling Google's Text to Speech Model """ 
-    client = texttospeech.TextToSpeechClient.from_service_account_file(GCP_KEY)
+# Voice settings, also part of the TTS cache key
+tts_voice = {
+    "language_code": "en-IN",
+    "name": "en-IN-Standard-A",
+    "ssml_gender": "FEMALE",
+}
+
+# Audio formats a reply can be sent in
+reply_formats = {
+    "wav": {"audio_encoding": "LINEAR16", "mimetype": "audio/wav", "extension": "wav"},
+    "mp3": {"audio_encoding": "MP3", "mimetype": "audio/mpeg", "extension": "mp3"},
+    "ogg": {"audio_encoding": "OGG_OPUS", "mimetype": "audio/ogg", "extension": "ogg"},
+}
+
+def call_tts(text: str, reply_format: str = "wav"):
+    """ Calling Google's Text to Speech Model, returns the audio bytes 
+        in the reply format. Short replies are served from the TTS cache when possible """ 
+    tts_audio = {"audio_encoding": reply_formats[reply_format]["audio_encoding"]}
+    key = None
+    if TTS_CACHE_ENABLED and tts_cache.is_cacheable(text):
+        key = tts_cache.cache_key(text, tts_voice, tts_audio)
+        cached_audio = tts_cache.get_audio(key)
+        if cached_audio is not None:
+            return cached_audio
+
+    from google.cloud import texttospeech
+    client = get_client("tts")
 
     # Making Required Parameters
     synthesis_input = texttospeech.SynthesisInput(text=text)
     voice = texttospeech.VoiceSelectionParams(
-        language_code="en-IN",
-        name="en-IN-Standard-A",
-        ssml_gender=texttospeech.SsmlVoiceGender.FEMALE
+        language_code=tts_voice["language_code"],
+        name=tts_voice["name"],
+        ssml_gender=texttospeech.SsmlVoiceGender[tts_voice["ssml_gender"]]
     )
     audio_config = texttospeech.AudioConfig(
-        audio_encoding=texttospeech.AudioEncoding.LINEAR16
+        audio_encoding=texttospeech.AudioEncoding[tts_audio["audio_encoding"]]
     )
     # Perform the text-to-speech request
-    response = client.synthesize_speech(
-        input=synthesis_input,
-        voice=voice,
-        audio_config=audio_config
-    )
-    # Write the binary audio content to a file.
-    with open(output_file, "wb") as out_file:
-        out_file.write(response.audio_content)
+    with track_call("tts"):
+        response = client.synthesize_speech(
+            input=synthesis_input,
+            voice=voice,
+            audio_config=audio_config
+        )
+
+    if key is not None:
+        tts_cache.set_audio(key, response.audio_content)
+    return response.audio_content
 
 # ----------------------------------------------------------------------
 # Speech Emotion Recognition Model from huggingface.co
 # ----------------------------------------------------------------------
 
-pipe = pipeline("audio-classification", 
-                model="ehcalabres/wav2vec2-lg-xlsr-en-speech-emotion-recognition")
-def extract_emotion(input_file : str):
-    results = pipe(input_file)
-    
-    # Find the emotion with the highest score
-    best_result = max(results, key=lambda x: x['score'])
-    
-    print("Emotion Detected: ", best_result['label'])
-    return best_result['label']
+# The model is loaded on first use (or by warmup_models), so modules that 
+# only need Firestore or Gemini never pay for it
+ser_infer = None
+ser_infer_lock = Lock()
+
+def get_ser_infer():
+    global ser_infer
+    if ser_infer is None:
+        with ser_infer_lock:
+            if ser_infer is None:
+                ser_infer = load_backend(SER_BACKEND)
+    return ser_infer
+
+# Concurrent requests share one forward pass per batch
+ser_batcher = SERBatcher(lambda batch: get_ser_infer()(batch),
+                         max_batch_size=SER_MAX_BATCH_SIZE,
+                         max_wait_ms=SER_MAX_WAIT_MS)
+
+def classify(inputs: List):
+    """ Runs the SER model on inputs, at most SER_MAX_BATCH_SIZE per forward pass """
+    if SER_BATCHING_ENABLED:
+        futures = [ser_batcher.submit(item) for item in inputs]
+        return [future.result() for future in futures]
+
+    results = []
+    for i in range(0, len(inputs), SER_MAX_BATCH_SIZE):
+        results += get_ser_infer()(inputs[i:i + SER_MAX_BATCH_SIZE])
+    return results
+
+def window_starts(num_samples: int, window: int, hop: int):
+    """ Start of every window, the last one is aligned to the end of the clip """
+    if num_samples <= window:
+        return [0]
+    starts = list(range(0, num_samples - window + 1, hop))
+    if starts[-1] + window < num_samples:
+        starts.append(num_samples - window)
+    return starts
+
+def extract_emotion_timeline(decoded: DecodedAudio):
+    """ Classifies the clip in overlapping fixed length windows, so the cost and 
+        memory of a forward pass do not grow with clip length.
+        Returns the clip label (highest mean score over all windows) and 
+        the best label of every window """
+    waveform = decoded.samples
+    if len(waveform) == 0:
+        raise ValueError("No audio to classify")
+    if SER_WINDOWING_ENABLED:
+        window = int(SER_WINDOW_SECONDS * decoded.sample_rate)
+        hop = int(SER_WINDOW_HOP_SECONDS * decoded.sample_rate)
+    else:
+        # The whole clip as a single window
+        window = hop = max(len(waveform), 1)
+    starts = window_starts(len(waveform), window, hop)
+
+    # The windows share the decoded samples and need no further decoding 
+    # or resampling by the pipeline
+    min_samples = int(SER_MIN_WINDOW_SECONDS * decoded.sample_rate)
+    results = classify([decoded.ser_input(start, window, min_samples) for start in starts])
+
+    clip_scores = defaultdict(float)
+    timeline = []
+    for start, window_results in zip(starts, results):
+        for result in window_results:
+            clip_scores[result['label']] += result['score'] / len(results)
+        best_result = max(window_results, key=lambda x: x['score'])
+        timeline.append({"start": round(start / decoded.sample_rate, 2),
+                         "end": round(min(start + window, len(waveform)) / decoded.sample_rate, 2),
+                         "label": best_result['label'],
+                         "score": round(best_result['score'], 4)})
+
+    label = max(clip_scores, key=clip_scores.get)
+    print("Emotion Detected: ", label, "over", len(timeline), "windows")
+    return label, timeline
+
+def extract_emotion(decoded: DecodedAudio):
+    label, _ = extract_emotion_timeline(decoded)
+    return label
 
 
 # ----------------------------------------------------------------------
 # Helper function for Audio Related Tasks
 # ----------------------------------------------------------------------
 
-def get_wav_duration(file_path):
-    sample_rate, data = wavfile.read(file_path)
-    duration = len(data) / sample_rate  # Duration in seconds
+def get_reply_duration(audio_bytes: bytes, reply_format: str = "wav"):
+    """ Duration in seconds of a TTS reply """
+    if reply_format == "wav":
+        return get_wav_duration(audio_bytes)
+    try:
+        return encoded_duration(audio_bytes)
+    except Exception as e:
+        print("Could not read the reply duration: ", str(e))
+        return 0
+
+def get_wav_duration(audio_bytes: bytes):
+    """ Duration in seconds of WAV audio, read from the header when possible """
+    # PCM - the frame count follows from the byte length of the data chunk
+    duration = wav_header_duration(audio_bytes)
+    if duration is None:
+        # Non PCM (e.g. float) WAV, fall back to decoding the samples
+        sample_rate, data = wavfile.read(io.BytesIO(audio_bytes))
+        duration = len(data) / sample_rate
     return duration
 
-def convert_to_mono(input_file: str, output_file: str):
-    """ Converting a file to Mono Audio using SciPy """ 
-    sample_rate, data = wavfile.read(input_file)
 
-    if data.ndim == 2: #if Dual Audio then convert to Mono
-        mono_data = data.mean(axis=1).astype(data.dtype)
-    else: # Already mono
-        mono_data = data
+# ----------------------------------------------------------------------
+# Helper function for streaming replies
+# ----------------------------------------------------------------------
+
+sentence_end = re.compile(r"(?<=[.!?])\s+")
+
+def split_sentences(chunks: Iterable[str], min_chars: int = STREAM_MIN_CHUNK_CHARS) -> Iterator[str]:
+    """ Regroups streamed text into sentences as soon as they are complete.
+        Sentences shorter than min_chars are joined with the next one, 
+        so TTS is not called for every tiny fragment """
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            boundary = next((match for match in sentence_end.finditer(buffer)
+                             if match.start() >= min_chars), None)
+            if boundary is None:
+                break
+            yield buffer[:boundary.start()].strip()
+            buffer = buffer[boundary.end():]
+
+    if buffer.strip():
+        yield buffer.strip()
+
+
+# ----------------------------------------------------------------------
+# Helper functions for running the stages of a voice turn
+# ----------------------------------------------------------------------
 
-    wavfile.write(output_file, sample_rate, mono_data)
-    return sample_rate
+stage_executor = ThreadPoolExecutor(max_workers=VOICE_STAGE_WORKERS,
+                                    thread_name_prefix="voice-stage")
+
+def timed(func: Callable, *args):
+    """ Runs func and returns its result together with the seconds it took """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def run_stages(stages: Dict[str, Tuple]) -> Dict[str, Future]:
+    """ Starts independent stages concurrently. 
+        stages maps a name to (func, *args), the returned futures 
+        resolve to (result, seconds) or raise the stage's exception """
+    return { name: stage_executor.submit(timed, *stage)
+             for name, stage in stages.items() }
+
+def log_stage_timings(stage_timings: Dict[str, float], wall_seconds: float):
+    """ Logs how long every stage took and how much running them concurrently saved """
+    stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in stage_timings.items())
+    saved = sum(stage_timings.values()) - wall_seconds
+    print(f"Voice stages: {stages} | wall {wall_seconds:.2f}s, saved {saved:.2f}s")
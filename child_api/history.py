@@ -0,0 +1,105 @@
+import json
+from typing import List, Optional
+
+from child_api.conversation_store import drop_turns
+from child_api.gemini import call_gemini_plain
+from child_api.helper import stage_executor
+from config import HISTORY_FOLD_TTL_SECONDS, HISTORY_KEEP_TURNS, HISTORY_TOKEN_BUDGET
+from redis_store import redis
+
+# ----------------------------------------------------------------------
+# Rolling compaction of the voice chat history.
+#
+# The history kept in Redis is the persona entry followed by the
+# most recent user/model turns. Once the turns go over HISTORY_KEEP_TURNS
+# or HISTORY_TOKEN_BUDGET, the oldest ones are folded into a running
+# summary by a background Gemini call. The result is parked in Redis and
+# applied at the start of the next turn, so no turn waits for it.
+# ----------------------------------------------------------------------
+
+# A crashed fold releases its lock after this long
+FOLD_LOCK_SECONDS = 120
+
+fold_prompt = "Update the running summary of a conversation between a child (user) and Aasha (model) with the new messages. Keep what the child shared about themselves, their feelings and any worries. Maximum 150 words. Plain text only."
+
+def fold_key(conversation_id: str):
+    return f"history:fold:{conversation_id}"
+
+def folding_key(conversation_id: str):
+    return f"history:folding:{conversation_id}"
+
+def estimate_tokens(entries: List[dict]):
+    """ Rough token count (4 characters per token), cheap enough to run every turn """
+    return sum(len(entry["parts"]) for entry in entries) // 4
+
+def persona_offset(chat_history: List[dict]):
+    """ 1 if the history starts with the persona entry, the turns come after it """
+    return 1 if chat_history and chat_history[0]["role"] == "model" else 0
+
+def with_summary(chat_history: List[dict], summary: Optional[str]):
+    """ Copy of the history with the running summary added to the persona entry """
+    if not summary or not persona_offset(chat_history):
+        return chat_history
+    persona = dict(chat_history[0])
+    persona["parts"] = persona["parts"] + " Summary of the conversation so far: " + summary
+    return [persona] + chat_history[1:]
+
+def apply_folded_summary(conversation_id: str, chat_history: List[dict], summary: Optional[str]):
+    """ Drops the turns folded by a finished background summary from the history,
+        in memory and in the conversation store. Returns the current running summary """
+    try:
+        # Read and deleted atomically, so of two overlapping turns only one 
+        # applies the fold and the turns are dropped once
+        pipe = redis.pipeline(transaction=True)
+        pipe.get(fold_key(conversation_id))
+        pipe.delete(fold_key(conversation_id))
+        folded, _ = pipe.execute()
+        if folded is None:
+            return summary
+    except Exception as e:
+        print("History compaction unavailable: ", str(e))
+        return summary
+
+    folded = json.loads(folded)
+    offset = persona_offset(chat_history)
+    drop_turns(conversation_id, chat_history[:offset], folded["turns_folded"], folded["summary"])
+    del chat_history[offset:offset + folded["turns_folded"]]
+    print(f"Folded {folded['turns_folded']} history entries into the summary")
+    return folded["summary"]
+
+def fold_turns(conversation_id: str, summary: Optional[str], turns: List[dict]):
+    """ Background job summarizing the oldest turns into the running summary """
+    try:
+        messages = "\n".join(f"{turn['role']}: {turn['parts']}" for turn in turns)
+        new_summary = call_gemini_plain(fold_prompt
+                                        + "\n\nCurrent summary: " + (summary or "None")
+                                        + "\n\nNew messages:\n" + messages)
+        redis.set(fold_key(conversation_id),
+                  json.dumps({"summary": new_summary.strip(), "turns_folded": len(turns)}),
+                  ex=HISTORY_FOLD_TTL_SECONDS)
+    except Exception as e:
+        print("Failed to fold chat history: ", str(e))
+    finally:
+        redis.delete(folding_key(conversation_id))
+
+def schedule_compaction(conversation_id: str, chat_history: List[dict], summary: Optional[str]):
+    """ Starts folding the turns over the budget unless a fold is already running
+        or waiting to be applied """
+    turns = chat_history[persona_offset(chat_history):]
+
+    # Keep the newest whole turns (user + model) that fit both limits
+    keep = min(len(turns), HISTORY_KEEP_TURNS * 2)
+    while keep > 2 and estimate_tokens(turns[-keep:]) > HISTORY_TOKEN_BUDGET:
+        keep -= 2
+    overflow = turns[:len(turns) - keep]
+    if len(overflow) < 2:
+        return
+
+    try:
+        if redis.exists(fold_key(conversation_id)) or \
+            not redis.set(folding_key(conversation_id), 1, nx=True, ex=FOLD_LOCK_SECONDS):
+            return
+    except Exception as e:
+        print("History compaction unavailable: ", str(e))
+        return
+    stage_executor.submit(fold_turns, conversation_id, summary, overflow)
@@ -0,0 +1,103 @@
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Callable, Dict
+
+from config import GCP_KEY, GEMINI_API_KEY, GEMINI_MODEL_NAME
+
+# ----------------------------------------------------------------------
+# Long lived clients for the Google APIs, created once per process.
+# The Speech and TTS clients hold a gRPC channel which is thread safe
+# but must not be shared across a fork, so a forked worker drops the
+# inherited clients and builds its own on first use. The client libraries
+# are imported on first use too, keeping this module cheap to import.
+# ----------------------------------------------------------------------
+
+def create_speech_client():
+    from google.cloud import speech_v1 as speech
+    return speech.SpeechClient.from_service_account_file(GCP_KEY)
+
+def create_tts_client():
+    from google.cloud import texttospeech
+    return texttospeech.TextToSpeechClient.from_service_account_file(GCP_KEY)
+
+def create_gemini_model():
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel(model_name=GEMINI_MODEL_NAME)
+
+factories: Dict[str, Callable[[], Any]] = {
+    "speech": create_speech_client,
+    "tts": create_tts_client,
+    "gemini": create_gemini_model,
+}
+
+clients: Dict[str, Any] = {}
+clients_lock = Lock()
+
+# Provider -> setup cost, and provider -> running call latency totals
+setup_timings: Dict[str, float] = {}
+call_timings: Dict[str, Dict[str, float]] = {}
+timings_lock = Lock()
+
+
+def get_client(name: str):
+    """ Returns the shared client of a provider, creating it on first use """
+    client = clients.get(name)
+    if client is not None:
+        return client
+
+    with clients_lock:
+        # Another thread may have created it while we waited
+        client = clients.get(name)
+        if client is None:
+            start = time.perf_counter()
+            client = factories[name]()
+            elapsed = time.perf_counter() - start
+            with timings_lock:
+                setup_timings[name] = elapsed
+            print(f"Created {name} client in {elapsed:.2f}s (pid {os.getpid()})")
+            clients[name] = client
+    return client
+
+def record_call(name: str, elapsed: float):
+    """ Records the latency of a call made with a provider's client """
+    with timings_lock:
+        stats = call_timings.setdefault(name, {"calls": 0, "total_seconds": 0.0})
+        stats["calls"] += 1
+        stats["total_seconds"] += elapsed
+
+@contextmanager
+def track_call(name: str):
+    """ Records the latency of the block as a call to `name` """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_call(name, time.perf_counter() - start)
+
+def get_provider_stats():
+    """ Setup cost and mean call latency for every provider and tracked call 
+        (e.g. gemini_stream) used so far """
+    with timings_lock:
+        return {
+            name: {
+                "setup_seconds": setup_timings.get(name),
+                "calls": call_timings.get(name, {}).get("calls", 0),
+                "mean_call_seconds": (call_timings[name]["total_seconds"] / call_timings[name]["calls"]
+                                      if name in call_timings else None),
+            }
+            for name in [*factories, *(name for name in call_timings if name not in factories)]
+        }
+
+def reset_after_fork():
+    """ Drops clients inherited from the parent process (gunicorn preload etc.) """
+    global clients_lock, timings_lock
+    clients_lock = Lock()
+    timings_lock = Lock()
+    clients.clear()
+    setup_timings.clear()
+    call_timings.clear()
+
+os.register_at_fork(after_in_child=reset_after_fork)
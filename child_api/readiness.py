@@ -0,0 +1,63 @@
+import time
+from threading import Event, Lock
+from typing import Any, Dict
+
+from config import MODEL_WARMUP_RETRIES, MODEL_WARMUP_RETRY_SECONDS
+
+# ----------------------------------------------------------------------
+# Warmup state of the process, reported by /common/ready. Kept apart
+# from child_api.helper so the routes reporting it do not import the
+# voice stack (numpy, scipy, the SER model and the Google clients).
+# ----------------------------------------------------------------------
+
+models_ready = Event()
+
+# pending / warming / ready / failed, with the error of the last attempt
+warmup_state: Dict[str, Any] = {"status": "pending", "attempts": 0, "error": None}
+warmup_state_lock = Lock()
+
+
+def set_state(**state):
+    with warmup_state_lock:
+        warmup_state.update(state)
+
+def get_warmup_state():
+    with warmup_state_lock:
+        return dict(warmup_state)
+
+def mark_ready():
+    set_state(status="ready", error=None)
+    models_ready.set()
+
+def warmup_models():
+    """ Loads the SER model, runs a dummy inference through it and creates the 
+        Google clients, then marks the process as ready. A failed attempt is
+        retried MODEL_WARMUP_RETRIES times before the process reports it failed """
+    import numpy as np
+
+    from child_api.audio import TARGET_SAMPLE_RATE, DecodedAudio
+    from child_api.helper import extract_emotion
+    from child_api.providers import get_client
+
+    start = time.perf_counter()
+    for attempt in range(1, MODEL_WARMUP_RETRIES + 2):
+        set_state(status="warming", attempts=attempt)
+        try:
+            silence = np.zeros(TARGET_SAMPLE_RATE, dtype=np.float32)
+            extract_emotion(DecodedAudio(silence, 1.0, TARGET_SAMPLE_RATE))
+
+            for provider in ("speech", "tts", "gemini"):
+                get_client(provider)
+        except Exception as e:
+            print(f"Warmup attempt {attempt} failed: ", str(e))
+            set_state(error=str(e))
+            if attempt <= MODEL_WARMUP_RETRIES:
+                time.sleep(MODEL_WARMUP_RETRY_SECONDS * attempt)
+            continue
+
+        mark_ready()
+        print(f"Warmup finished in {time.perf_counter() - start:.2f}s")
+        return
+
+    set_state(status="failed")
+    print("Warmup failed, not ready")
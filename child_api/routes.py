@@ -1,15 +1,25 @@
-import os
+import io
+import json
+import time
+import uuid
 import base64
-from flask import abort, send_file, jsonify, session
+from datetime import datetime, timedelta, timezone
+from collections import deque
+from flask import Response, request, send_file, jsonify, session, stream_with_context
 from flask_smorest import Blueprint
 from flask.views import MethodView
-from werkzeug.utils import secure_filename
-from config import UPLOAD_FOLDER
-from child_api.helper import call_chirp, call_gemini, call_tts, extract_emotion, get_wav_duration
-from child_api.schema import AudioSchema, ChildLoginSchma
-from firestore import add_new_conversation, check_username_password, fetch_all_conversations, fetch_chat_summary
-
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+from config import EMOTION_TIMELINE_HEADER_MAX_WINDOWS, END_CHAT_QUEUE
+from child_api.providers import get_provider_stats
+from child_api.tts_cache import get_cache_stats
+from child_api.gemini import call_gemini, call_gemini_stream, drop_chat_session, get_session_cache_stats
+from child_api.history import apply_folded_summary, schedule_compaction, with_summary
+from child_api.conversation_store import append_turn, delete_conversation, load_conversation, load_history
+from child_api.audio import DecodedAudio
+from child_api.helper import call_chirp, call_tts, extract_emotion_timeline, get_reply_duration, reply_formats, log_stage_timings, run_stages, ser_batcher, split_sentences, stage_executor
+from child_api.schema import AudioFormatSchema, AudioSchema, ChildLoginSchma, ConversationPageSchema
+from jobs import enqueue_job, get_job
+from sse import sse_event
+from firestore import InvalidCursor, check_username_password, fetch_all_conversations, fetch_chat_summary, get_analysis_timings
 
 child_bp = Blueprint('Child API', __name__, 
                     url_prefix='/child', 
@@ -19,116 +29,254 @@ child_bp = Blueprint('Child API', __name__,
 # CHATBOT ROUTES
 # -----------------------------------------------------------------
 
+def decode_upload(audio_bytes: bytes):
+    """ Decodes the uploaded audio once for every stage of the turn.
+        Returns (decoded audio, error response or None) """
+    try:
+        decoded = DecodedAudio.from_bytes(audio_bytes)
+    except Exception as e:
+        return None, (jsonify({"error":"Failed to decode audio, expected WAV, FLAC or OGG/Opus.", 
+                               "message": str(e) }), 400)
+    if len(decoded.samples) == 0:
+        return None, (jsonify({"error":"The audio is empty."}), 400)
+    return decoded, None
+
+def get_conversation_id():
+    """ Id of the ongoing voice chat, a new one starts after /end_chat """
+    if 'conversation_id' not in session:
+        session['conversation_id'] = uuid.uuid4().hex
+    return session['conversation_id']
+
+def negotiate_reply_format(requested: str | None):
+    """ Reply format from the format parameter, else the Accept header, else WAV """
+    if requested:
+        return requested
+    mimetypes = { reply_format["mimetype"]: name for name, reply_format in reply_formats.items() }
+    best = request.accept_mimetypes.best_match(list(mimetypes), default="audio/wav")
+    return mimetypes[best]
+
+def run_input_stages(decoded: DecodedAudio):
+    """ Transcribes the audio and extracts the emotion from it. Both only 
+        need the audio so they run concurrently.
+        Returns (transcription, emotion, emotion timeline, error response or None) """
+    stages_start = time.perf_counter()
+    stages = run_stages({ "transcribe": (call_chirp, decoded),
+                          "emotion": (extract_emotion_timeline, decoded) })
+    stage_timings = {}
+
+    try:
+        transcribed_resp, stage_timings["transcribe"] = stages["transcribe"].result()
+        print("Transribe: ", transcribed_resp)
+    except Exception as e:
+        return None, None, None, (jsonify({"error":"Google Chirp Failed to Transcribe.", 
+                                           "message": str(e) }), 500)
+
+    try: 
+        (emotion, emotion_timeline), stage_timings["emotion"] = stages["emotion"].result()
+    except Exception as e:
+        return None, None, None, (jsonify({"error":"SER Failed.", 
+                                           "message": str(e) }), 500)
+
+    log_stage_timings(stage_timings, time.perf_counter() - stages_start)
+    return transcribed_resp, emotion, emotion_timeline, None
+
+def start_voice_turn(audio_bytes: bytes):
+    """ Everything a voice turn needs before calling Gemini: the decoded upload,
+        its transcription and emotion, and the history of the conversation 
+        compacted by earlier turns.
+        Returns (turn dict, error response or None) """
+    # Decoded once and kept in memory for this request only
+    decoded, error = decode_upload(audio_bytes)
+    if error:
+        return None, error
+
+    # Transcribing it to text and extracting emotion from audio
+    transcribed_resp, emotion, emotion_timeline, error = run_input_stages(decoded)
+    if error:
+        return None, error
+
+    # Loading previos chat history, compacted by earlier turns
+    conversation_id = get_conversation_id()
+    chat_history, history_summary = load_history(conversation_id)
+    history_summary = apply_folded_summary(conversation_id, chat_history, history_summary)
+    prompt_history = with_summary(chat_history, history_summary)
+    return {"conversation_id": conversation_id,
+            "prompt": transcribed_resp,
+            "prompt_audio_duration": decoded.duration,
+            "emotion": emotion,
+            "emotion_timeline": emotion_timeline,
+            "chat_history": chat_history,
+            "history_summary": history_summary,
+            "prompt_history": prompt_history,
+            "history_len": len(prompt_history)}, None
+
+def save_voice_turn(turn: dict, reply: str, reply_audio_duration: float):
+    """ Appends the prompt and reply of a voice turn to the conversation 
+        and folds the oldest turns into the summary, off the critical path """
+    user_conv = {
+            "role":"user",
+            "parts":turn["prompt"],
+            }
+    model_conv = {
+            "role":"model",
+            "parts": reply ,
+            }
+
+    # Only the new entries are appended, the persona too on the first turn
+    history_len = turn["history_len"]
+    new_entries = turn["prompt_history"][history_len:] + [ user_conv, model_conv ]
+    chat_history = turn["chat_history"][:history_len] + new_entries
+    append_turn(turn["conversation_id"], new_entries, turn["emotion"], 
+                turn["prompt_audio_duration"] + reply_audio_duration)
+    schedule_compaction(turn["conversation_id"], chat_history, turn["history_summary"])
+
+def timeline_header(emotion_timeline: list, max_windows: int = EMOTION_TIMELINE_HEADER_MAX_WINDOWS):
+    """ Compact JSON of the emotion timeline for a response header. Long clips 
+        are downsampled to max_windows evenly spaced windows (first and last 
+        kept) so the header stays well under the proxies' size limits """
+    if len(emotion_timeline) > max_windows > 1:
+        step = (len(emotion_timeline) - 1) / (max_windows - 1)
+        emotion_timeline = [emotion_timeline[round(i * step)] for i in range(max_windows)]
+    return json.dumps(emotion_timeline, separators=(",", ":"))
+
+class TTSFailed(Exception):
+    """ A sentence of a streamed reply could not be synthesized """
+
 @child_bp.route("/voice_chat")
 class AudioRoute(MethodView):
     # POST REQUEST
     @child_bp.response(status_code=201, schema = AudioSchema)
     @child_bp.arguments(schema = AudioSchema, location='files')
-    def post(self, params):
-        ''' Voice to Voice Gemini Request Endpoint '''
-
-        # Acquiring the audio file provided
-        file = params['file']
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(UPLOAD_FOLDER,filename)
-        file.save(file_path)
-
-        # Getting the duration of audio sent
-        prompt_audio_duration = get_wav_duration(file_path)
-
-        # Transcribing it to text from audio
-        try:
-            transcribed_resp = call_chirp(file_path)
-            print("Transribe: ", transcribed_resp)
-        except Exception as e:
-            return jsonify({"error":"Google Chirp Failed to Transcribe.", 
-                            "message": str(e) }), 500
+    @child_bp.arguments(schema = AudioFormatSchema, location='query')
+    def post(self, params, format_params):
+        ''' Voice to Voice Gemini Request Endpoint. Takes WAV, FLAC or OGG/Opus audio and 
+        replies in WAV, MP3 or OGG/Opus depending on `format` or the Accept header '''
+        reply_format = negotiate_reply_format(format_params.get('format'))
 
-        # Extracting emotion from audio
-        try: 
-            emotion = extract_emotion(file_path)
-        except Exception as e:
-            return jsonify({"error":"SER Failed.", 
-                            "message": str(e) }), 500
-
-        # Storing emotion
-        emotion_arr = session.get('emotion',[]) + [emotion]
-        session['emotion'] = emotion_arr
-
-        # Loading previos chat history
-        chat_history = session.get('chat_history', [])
+        turn, error = start_voice_turn(params['file'].read())
+        if error:
+            return error
 
         # Generating Repsonse using Gemini
         try:
-            reply = call_gemini(transcribed_resp, chat_history, emotion)
+            reply = call_gemini(turn["prompt"], turn["prompt_history"], turn["emotion"], 
+                                turn["conversation_id"])
             print("Reply: ",reply)
         except Exception as e:
             return jsonify({"error":"Google Gemini Failed to Reply", 
                             "message": str(e) }), 500
 
         # Generating Speech from Test using TTS
-        output_file_path = 'output.wav'
         try:
-            call_tts( reply, output_file_path )
+            reply_audio = call_tts( reply, reply_format )
         except Exception as e:
             return jsonify({"error":"Google TTS Failed to make it into Audio", 
                             "message": str(e) }), 500
 
-        # Sending Newly created File
-        if not os.path.exists(output_file_path):
-            abort(404, description="File not found")
-
-        # Read and encode file as Base64
-        with open(output_file_path, "rb") as f:
-            file_data = base64.b64encode(f.read()).decode("utf-8")
+        save_voice_turn(turn, reply, get_reply_duration(reply_audio, reply_format))
 
+        response = send_file(
+            io.BytesIO(reply_audio),
+            mimetype=reply_formats[reply_format]['mimetype'],
+            as_attachment=True, 
+            download_name= 'output.' + reply_formats[reply_format]['extension']
+        )
+        # Per window emotions of the prompt audio, downsampled for long clips
+        response.headers['X-Emotion-Timeline'] = timeline_header(turn["emotion_timeline"])
+        response.headers['X-Emotion-Timeline-Windows'] = str(len(turn["emotion_timeline"]))
+        return response
 
-        reply_audio_duration = get_wav_duration(output_file_path) 
-
-        # Setting up chat history
-        user_conv = {
-                "role":"user",
-                "parts":transcribed_resp,
-                }
-        model_conv = {
-                "role":"model",
-                "parts": reply ,
-                }
-
-        if len(chat_history) == 0:
-            chat_history = [ user_conv, model_conv ]
-        else:
-            chat_history += [ user_conv, model_conv ]
-
-        # Storing session variables
-        session['chat_history'] = chat_history
-        session['duration'] = ( session.get('duration', 0)
-                                + prompt_audio_duration 
-                                + reply_audio_duration )
-
+@child_bp.route("/voice_chat_stream")
+class AudioStreamRoute(MethodView):
+    # POST REQUEST
+    @child_bp.response(status_code=200)
+    @child_bp.arguments(schema = AudioSchema, location='files')
+    @child_bp.arguments(schema = AudioFormatSchema, location='query')
+    def post(self, params, format_params):
+        ''' Voice to Voice Gemini Request Endpoint streaming the reply as server sent events.
+        Every `audio` event holds base64 audio of one or more sentences, `done` holds the full reply
+        and the per window emotions of the prompt audio '''
+        request_start = time.perf_counter()
+        reply_format = negotiate_reply_format(format_params.get('format'))
+
+        # A new conversation id is saved along with the response headers
+        turn, error = start_voice_turn(params['file'].read())
+        if error:
+            return error
+
+        def generate():
+            reply_chunks = []
+            reply_audio_duration = 0
+            # (sentence, TTS future) in the order they have to be sent
+            pending = deque()
+
+            def gemini_chunks():
+                for chunk in call_gemini_stream(turn["prompt"], turn["prompt_history"], turn["emotion"], 
+                                                turn["conversation_id"]):
+                    reply_chunks.append(chunk)
+                    yield chunk
+
+            first_audio_sent = False
+
+            def audio_events(wait_for_all: bool):
+                # The first chunk is always waited for, it decides time to first audio
+                nonlocal reply_audio_duration, first_audio_sent
+                while pending and (wait_for_all or not first_audio_sent
+                                   or pending[0][1].done()):
+                    sentence, tts_future = pending.popleft()
+                    try:
+                        reply_audio = tts_future.result()
+                    except Exception as e:
+                        raise TTSFailed(str(e)) from e
+                    if not first_audio_sent:
+                        first_audio_sent = True
+                        print(f"Time to first audio: {time.perf_counter() - request_start:.2f}s")
+                    reply_audio_duration += get_reply_duration(reply_audio, reply_format)
+                    yield sse_event("audio", {"text": sentence,
+                                              "mimetype": reply_formats[reply_format]['mimetype'],
+                                              "audio": base64.b64encode(reply_audio).decode("utf-8")})
+
+            # Every sentence is synthesized as soon as Gemini completes it
+            try:
+                for sentence in split_sentences(gemini_chunks()):
+                    pending.append((sentence, stage_executor.submit(call_tts, sentence, reply_format)))
+                    yield from audio_events(wait_for_all=False)
+                yield from audio_events(wait_for_all=True)
+            except TTSFailed as e:
+                yield sse_event("error", {"error":"Google TTS Failed to make it into Audio", 
+                                          "message": str(e) })
+                return
+            except Exception as e:
+                yield sse_event("error", {"error":"Google Gemini Failed to Reply", 
+                                          "message": str(e) })
+                return
+
+            reply = "".join(reply_chunks)
+            print("Reply: ",reply)
 
-        # print(session.get('emotion', ''))
-        # print(session.get('chat_history', ''))
-        # print(session.get('duration', ''))
+            save_voice_turn(turn, reply, reply_audio_duration)
+            yield sse_event("done", {"text": reply, "emotion_timeline": turn["emotion_timeline"]})
 
-        return send_file(
-            output_file_path,
-            mimetype='audio/wav',
-            as_attachment=True, 
-            download_name= output_file_path 
-        )
+        return Response(stream_with_context(generate()),
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache",
+                                 "X-Accel-Buffering": "no"})
 
 @child_bp.route("/end_chat")
 class EndChat(MethodView):
-    @child_bp.response(status_code=200)
+    @child_bp.response(status_code=202)
     def post(self):
-        ''' End call endpoint to save chat information '''
+        ''' End call endpoint to queue saving the chat information '''
         
-        # Fetch all required information from session cookie
+        # Fetch all required information from the session cookie and the conversation store
         child_id = session.get('child_id', None)
-        emotion = session.get('emotion', None)
-        duration = session.get('duration', None)
-        chat_history = session.get('chat_history', None)
+        conversation_id = session.get('conversation_id', None)
+        if conversation_id:
+            chat_history, emotion, duration, history_summary = load_conversation(conversation_id)
+            # Older turns only survive in the running summary
+            chat_history = with_summary(chat_history, history_summary)
+        else:
+            chat_history, emotion, duration = None, None, None
         if not child_id:
             return {"status":404, "message": "Child_ID not found"}, 404
         if not chat_history:
@@ -138,16 +286,43 @@ class EndChat(MethodView):
         if not duration:
             return {"status":404, "message": "Duration not found"}, 404
 
-        # Save all of them as a new conversation document in Firestore
-        status, mssg = add_new_conversation( child_id, chat_history , emotion, duration )
+        # Snapshot the chat into a job, the worker saves it as a new 
+        # conversation document in Firestore. The conversation is dated when 
+        # the chat ended, not when a (delayed or retried) job runs
+        try:
+            job_id = enqueue_job(END_CHAT_QUEUE, {"child_id": child_id,
+                                                  "chat_history": chat_history,
+                                                  "emotion": emotion,
+                                                  "duration": duration,
+                                                  "ended_at": datetime.now(timezone.utc).isoformat()})
+        except Exception as e:
+            return { "status":500, "message": "Failed to queue chat: " + str(e)}, 500
+
+        delete_conversation(conversation_id)
+        drop_chat_session(conversation_id)
+        session.pop("conversation_id", None)
+
+        return { "status": 202, "message": "Chat queued for saving", "job_id": job_id }, 202
+
+@child_bp.route("/end_chat/<string:job_id>")
+class EndChatStatus(MethodView):
+    @child_bp.response(status_code=200)
+    def get(self, job_id):
+        ''' Status of a queued end call job '''
+        child_id = session.get('child_id', None)
+        if not child_id:
+            return {"status":404, "message": "Child_ID not found"}, 404
 
-        session.pop("chat_history", None)
-        session.pop("duration", None)
-        session.pop("emotion", None)
+        job = get_job(job_id)
+        if job is None or job['payload'].get('child_id') != child_id:
+            return {"status":404, "message": "Job not found"}, 404
 
-        if status == False:
-            return { "status":400, "message":mssg}, 400
-        return { "status": 200 , "message":mssg }
+        # queued / running / retrying / done / failed
+        return { "status": 200,
+                 "job_id": job_id,
+                 "state": job['status'],
+                 "attempts": job['attempts'],
+                 "message": job.get('result', job.get('error', "")) }
 
 # -----------------------------------------------------------------
 # FIRESTORE ROUTES
@@ -176,8 +351,11 @@ class ChildLoginPOST(MethodView):
 @child_bp.route("/fetch_summary")
 class ChildSummary(MethodView):
     @child_bp.response(status_code=200)
-    def get(self):
-        '''Return back the summary and a list of all the conversations of this child'''
+    @child_bp.arguments(schema=ConversationPageSchema, location='query')
+    def get(self, page):
+        '''Return back the summary and the latest page of conversations of this child,
+        pass next_start_after as start_after for the next page. `days` or `since` / `until`
+        limit the conversations to a time range'''
         child_id = session.get('child_id', None)  
         if child_id == None:
             return {"status":404,
@@ -188,8 +366,14 @@ class ChildSummary(MethodView):
             return {"status":404,
                     "message": "Chat Summary not found" }, 404
 
-        # Fetch conversation list
-        chat_summary['conversation_list'] = fetch_all_conversations(child_id)
+        # Fetch a page of the conversation list
+        days = page.pop('days')
+        if days:
+            page['since'] = datetime.now(timezone.utc) - timedelta(days=days)
+        try:
+            chat_summary['conversation_list'], chat_summary['next_start_after'] = fetch_all_conversations(child_id, **page)
+        except InvalidCursor as e:
+            return {"status":400, "message": str(e)}, 400
 
         # Change format of durations
         for chat in chat_summary['conversation_list']:
@@ -213,8 +397,43 @@ class ClearCookies(MethodView):
     @child_bp.response(status_code=200)
     def get(self):
         '''delete all session cookies'''
-        session.pop("chat_history", None)
+        conversation_id = session.pop("conversation_id", None)
+        delete_conversation(conversation_id)
+        drop_chat_session(conversation_id)
         session.pop("child_id", None)
-        session.pop("duration", None)
-        session.pop("emotion", None)
         return {"status":200, "message":"Cleared all session cookies"}
+
+@child_bp.route("/analysis_timings")
+class AnalysisTimings(MethodView):
+    @child_bp.response(status_code=200)
+    def get(self):
+        '''latency of the end of chat analysis per mode'''
+        return {"status":200, "timings": get_analysis_timings()}
+
+@child_bp.route("/provider_stats")
+class ProviderStats(MethodView):
+    @child_bp.response(status_code=200)
+    def get(self):
+        '''client setup cost and call latency of the Google APIs'''
+        return {"status":200, "providers": get_provider_stats()}
+
+@child_bp.route("/tts_cache_stats")
+class TTSCacheStats(MethodView):
+    @child_bp.response(status_code=200)
+    def get(self):
+        '''hit/miss/byte counters of the TTS cache'''
+        return {"status":200, "tts_cache": get_cache_stats()}
+
+@child_bp.route("/ser_stats")
+class SERStats(MethodView):
+    @child_bp.response(status_code=200)
+    def get(self):
+        '''queue depth and batch size metrics of the emotion model'''
+        return {"status":200, "ser": ser_batcher.stats()}
+
+@child_bp.route("/gemini_session_stats")
+class GeminiSessionStats(MethodView):
+    @child_bp.response(status_code=200)
+    def get(self):
+        '''hit rate, evictions and memory of the cached Gemini chat sessions'''
+        return {"status":200, "gemini_sessions": get_session_cache_stats()}
@@ -1,5 +1,9 @@
+from datetime import timezone
+
 from marshmallow import Schema, fields, validate
 
+from common_api.schema import PageSchema
+
 class TextSchema(Schema):
     text = fields.Str()
 
@@ -7,6 +11,19 @@ class AudioSchema(Schema):
     file = fields.Field(required=True, 
                         metadata={"type": "string", "format": "binary"})
 
+class AudioFormatSchema(Schema):
+    # Format of the reply audio, if missing it is picked from the Accept header
+    format = fields.Str(validate=validate.OneOf(["wav", "mp3", "ogg"]))
+
+# ---------------------------
+# Schemas for /child/fetch_summary
+# ---------------------------
+class ConversationPageSchema(PageSchema):
+    # Conversations of the last `days` days, or between since and until
+    days = fields.Int(missing=None, validate=validate.Range(min=1, max=366))
+    since = fields.AwareDateTime(missing=None, default_timezone=timezone.utc)
+    until = fields.AwareDateTime(missing=None, default_timezone=timezone.utc)
+
 # ---------------------------
 # Schemas for /child/login
 # ---------------------------
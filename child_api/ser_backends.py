@@ -0,0 +1,92 @@
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+from config import SER_MODEL_NAME, SER_ONNX_PATH
+
+# ----------------------------------------------------------------------
+# Backends for the speech emotion recognition model. Every backend is a
+# function taking a batch of inputs (WAV bytes or 16kHz float arrays) and
+# returning, per input, the labels with their scores sorted best first,
+# the same output as the HF audio-classification pipeline.
+#   pytorch   - the HF pipeline in full precision
+#   quantized - the HF pipeline with Linear layers dynamically quantized to int8
+#   onnx      - a graph exported with `python manage.py export-ser-onnx`, run by onnxruntime
+# ----------------------------------------------------------------------
+
+SAMPLING_RATE = 16000
+
+InferFn = Callable[[List[Any]], List[List[Dict[str, Any]]]]
+
+
+def load_pytorch_backend() -> InferFn:
+    from transformers import pipeline
+
+    pipe = pipeline("audio-classification", model=SER_MODEL_NAME)
+    return lambda batch: pipe(batch, batch_size=len(batch))
+
+def load_quantized_backend() -> InferFn:
+    import torch
+    from transformers import pipeline
+
+    pipe = pipeline("audio-classification", model=SER_MODEL_NAME)
+    pipe.model = torch.quantization.quantize_dynamic(pipe.model, {torch.nn.Linear}, dtype=torch.qint8)
+    return lambda batch: pipe(batch, batch_size=len(batch))
+
+def load_onnx_backend() -> InferFn:
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError("The onnx SER backend needs onnxruntime, pip install onnxruntime") from e
+    from transformers import AutoConfig, AutoFeatureExtractor
+
+    feature_extractor = AutoFeatureExtractor.from_pretrained(SER_MODEL_NAME)
+    id2label = AutoConfig.from_pretrained(SER_MODEL_NAME).id2label
+    session = onnxruntime.InferenceSession(SER_ONNX_PATH, providers=["CPUExecutionProvider"])
+    input_names = [graph_input.name for graph_input in session.get_inputs()]
+
+    def infer(batch):
+        features = feature_extractor([to_waveform(item) for item in batch],
+                                     sampling_rate=SAMPLING_RATE,
+                                     padding=True,
+                                     return_tensors="np")
+        logits = session.run(None, {name: features[name] for name in input_names})[0]
+        return [scores_to_labels(row, id2label) for row in softmax(logits)]
+
+    return infer
+
+backends: Dict[str, Callable[[], InferFn]] = {
+    "pytorch": load_pytorch_backend,
+    "quantized": load_quantized_backend,
+    "onnx": load_onnx_backend,
+}
+
+def load_backend(name: str) -> InferFn:
+    if name not in backends:
+        raise ValueError(f"Unknown SER backend '{name}', expected one of {list(backends)}")
+    print(f"Loading SER backend: {name}")
+    return backends[name]()
+
+
+# ----------------------------------------------------------------------
+# Helper functions shared by the backends
+# ----------------------------------------------------------------------
+
+def to_waveform(item) -> np.ndarray:
+    """ 16kHz mono float32 samples of an input """
+    if isinstance(item, bytes):
+        from transformers.pipelines.audio_utils import ffmpeg_read
+        return ffmpeg_read(item, SAMPLING_RATE)
+    if isinstance(item, dict):
+        if item["sampling_rate"] != SAMPLING_RATE:
+            raise ValueError(f"Expected audio sampled at {SAMPLING_RATE}Hz")
+        return np.asarray(item["raw"], dtype=np.float32)
+    return np.asarray(item, dtype=np.float32)
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+def scores_to_labels(scores: np.ndarray, id2label: Dict[int, str]):
+    order = np.argsort(scores)[::-1]
+    return [{"label": id2label[int(i)], "score": float(scores[i])} for i in order]
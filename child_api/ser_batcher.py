@@ -0,0 +1,106 @@
+import os
+import time
+from collections import Counter
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Lock, Thread
+from typing import Any, Callable, List
+
+
+class SERBatcher:
+    """ Collects concurrent speech emotion requests into batches.
+
+        Callers submit one input and get a Future. A single scheduler thread
+        waits for the first request, keeps collecting until max_batch_size
+        requests arrived or max_wait_ms passed, and runs infer once on the
+        whole batch. infer takes a list of inputs and returns one result per
+        input, in order (the HF pipeline pads the batch itself) """
+
+    def __init__(self,
+                 infer: Callable[[List[Any]], List[Any]],
+                 max_batch_size: int,
+                 max_wait_ms: float):
+        self.infer = infer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.reset()
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        """ Fresh queue and no scheduler thread, also used in forked children
+            where the parent's thread does not exist """
+        self.queue: "Queue[tuple]" = Queue()
+        self.thread = None
+        self.start_lock = Lock()
+        self.stats_lock = Lock()
+        self.batch_sizes = Counter()
+        self.requests = 0
+        self.max_queue_depth = 0
+        self.infer_seconds = 0.0
+
+    def submit(self, item: Any) -> Future:
+        self.ensure_started()
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def ensure_started(self):
+        if self.thread is not None:
+            return
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name="ser-batcher", daemon=True)
+                self.thread.start()
+
+    def next_batch(self):
+        """ Blocks for the first request, then fills the batch until it is full
+            or the wait window closes """
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            queue_depth = self.queue.qsize()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+
+            start = time.perf_counter()
+            try:
+                results = self.infer(items)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.stats_lock:
+                    self.batch_sizes[len(batch)] += 1
+                    self.requests += len(batch)
+                    self.max_queue_depth = max(self.max_queue_depth, queue_depth + len(batch))
+                    self.infer_seconds += elapsed
+
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+    def stats(self):
+        with self.stats_lock:
+            batches = sum(self.batch_sizes.values())
+            return {
+                "queue_depth": self.queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "requests": self.requests,
+                "batches": batches,
+                "mean_batch_size": self.requests / batches if batches else None,
+                "batch_size_histogram": dict(self.batch_sizes),
+                "mean_batch_seconds": self.infer_seconds / batches if batches else None,
+            }
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import time
+import unicodedata
+from threading import Lock
+from typing import Dict, Optional
+
+from config import TTS_CACHE_MAX_TEXT_CHARS, TTS_CACHE_MEMORY_BYTES, TTS_CACHE_REDIS_ITEMS, TTS_CACHE_TTL_SECONDS
+from lru import LRUCache
+from redis_store import redis
+
+# ----------------------------------------------------------------------
+# Content addressed cache of synthesized speech.
+#   memory tier - per process LRU bounded by bytes
+#   redis tier  - shared by every worker, LRU bounded by item count
+#                 using a sorted set of last access times
+# ----------------------------------------------------------------------
+
+REDIS_AUDIO_PREFIX = "tts:audio:"
+REDIS_LRU_KEY = "tts:lru"
+
+memory_tier = LRUCache(max_size=TTS_CACHE_MEMORY_BYTES, sizeof=len)
+
+metrics: Dict[str, int] = {
+    "memory_hits": 0,
+    "redis_hits": 0,
+    "misses": 0,
+    "bytes_served": 0,
+    "bytes_stored": 0,
+    "redis_evictions": 0,
+}
+metrics_lock = Lock()
+
+
+def count(metric: str, amount: int = 1):
+    with metrics_lock:
+        metrics[metric] += amount
+
+def normalize_text(text: str):
+    """ Text variations that synthesize to the same audio map to the same key """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def cache_key(text: str, voice_config: Dict, audio_config: Dict):
+    """ Hash of the normalized text together with everything that changes the audio """
+    material = json.dumps({"text": normalize_text(text),
+                           "voice": voice_config,
+                           "audio": audio_config}, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def is_cacheable(text: str):
+    """ Only short replies repeat often enough to be worth storing """
+    return len(normalize_text(text)) <= TTS_CACHE_MAX_TEXT_CHARS
+
+def get_audio(key: str) -> Optional[bytes]:
+    audio = memory_tier.get(key)
+    if audio is not None:
+        count("memory_hits")
+        count("bytes_served", len(audio))
+        return audio
+
+    try:
+        audio = redis.get(REDIS_AUDIO_PREFIX + key)
+    except Exception as e:
+        print("TTS cache unavailable: ", str(e))
+        audio = None
+
+    if audio is None:
+        count("misses")
+        return None
+
+    # Mark as recently used and promote into the memory tier
+    try:
+        pipe = redis.pipeline()
+        pipe.zadd(REDIS_LRU_KEY, {key: time.time()})
+        pipe.expire(REDIS_AUDIO_PREFIX + key, TTS_CACHE_TTL_SECONDS)
+        pipe.execute()
+    except Exception as e:
+        print("TTS cache unavailable: ", str(e))
+    memory_tier.set(key, audio)
+    count("redis_hits")
+    count("bytes_served", len(audio))
+    return audio
+
+def set_audio(key: str, audio: bytes):
+    memory_tier.set(key, audio)
+    count("bytes_stored", len(audio))
+    try:
+        pipe = redis.pipeline()
+        pipe.set(REDIS_AUDIO_PREFIX + key, audio, ex=TTS_CACHE_TTL_SECONDS)
+        pipe.zadd(REDIS_LRU_KEY, {key: time.time()})
+        pipe.zcard(REDIS_LRU_KEY)
+        size = pipe.execute()[-1]
+
+        # Evict the least recently used entries over the limit
+        if size > TTS_CACHE_REDIS_ITEMS:
+            evicted = redis.zpopmin(REDIS_LRU_KEY, size - TTS_CACHE_REDIS_ITEMS)
+            if evicted:
+                redis.delete(*[REDIS_AUDIO_PREFIX + old_key.decode() for old_key, _ in evicted])
+                count("redis_evictions", len(evicted))
+    except Exception as e:
+        print("TTS cache unavailable: ", str(e))
+
+def get_cache_stats():
+    with metrics_lock:
+        stats = dict(metrics)
+    lookups = stats["memory_hits"] + stats["redis_hits"] + stats["misses"]
+    stats["hit_rate"] = (stats["memory_hits"] + stats["redis_hits"]) / lookups if lookups else None
+    stats["memory_tier"] = memory_tier.stats()
+    return stats
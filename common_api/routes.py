@@ -1,11 +1,15 @@
 
 from flask import session
+from marshmallow import Schema, ValidationError
 from flask.views import MethodView
 from flask_smorest import Blueprint
 
-from common_api.schema import ChildDetailsSchema, HabitualTaskDELSchema, HabitualTaskPOSTSchema, HabitualTaskPUTSchema, LearningTaskDELSchema, LearningTaskPOSTSchema, LerningTaskPUTSchema
-from firestore import add_habitual_task, add_learning_task, delete_habitual_task, delete_learning_task, get_child_entry, list_all_habitual_tasks, list_all_learning_tasks, update_habitual_task, update_learning_task
+from child_api.readiness import get_warmup_state
+from common_api.schema import ChildDetailsSchema, HabitualTaskDELSchema, HabitualTaskPOSTSchema, HabitualTaskPUTSchema, LearningTaskDELSchema, LearningTaskPOSTSchema, LerningTaskPUTSchema, PageSchema, TaskBatchSchema
+from config import HABITUAL_TASKS_COLLECTION_NAME, LEARNING_TASKS_COLLECTION_NAME
+from firestore import InvalidCursor, batch_add_tasks, batch_delete_tasks, batch_update_tasks, add_habitual_task, add_learning_task, delete_habitual_task, delete_learning_task, get_child_entry, list_all_habitual_tasks, list_all_learning_tasks, list_points_ledger, refresh_stress_narrative, update_habitual_task, update_learning_task
 from firestore_schema import HabitualTask, LearningTask
+from firestore_cache import get_cache_stats
 
 
 # --------------------------------------------------------------------
@@ -32,16 +36,21 @@ common_learning_bp = Blueprint('Shared API - Learning Tasks', __name__,
 class HabitualView(MethodView):
     
     @common_habitual_bp.response(status_code=200)
-    def get(self):
-        ''' Fetches all habitual tasks '''
+    @common_habitual_bp.arguments(schema=PageSchema, location='query')
+    def get(self, page):
+        ''' Fetches a page of habitual tasks, pass next_start_after as start_after for the next one '''
         child_id = session.get('child_id', None)  
         if child_id == None:
             return {"status":400,
                     "message": "Child_ID not found" }, 400 
-        list_of_tasks = list_all_habitual_tasks(child_id)
+        try:
+            list_of_tasks, next_start_after = list_all_habitual_tasks(child_id, **page)
+        except InvalidCursor as e:
+            return {"status":400, "message": str(e)}, 400
         return {"status":200, 
                 "message": "Successfully retrieved all tasks", 
-                "habitual_tasks": list_of_tasks }
+                "habitual_tasks": list_of_tasks,
+                "next_start_after": next_start_after }
 
     @common_habitual_bp.response(status_code=201)
     @common_habitual_bp.arguments(schema=HabitualTaskPOSTSchema)
@@ -96,16 +105,21 @@ class HabitualView(MethodView):
 class LearningView(MethodView):
     
     @common_learning_bp.response(status_code=200)
-    def get(self):
-        ''' Fetches all learning tasks '''
+    @common_learning_bp.arguments(schema=PageSchema, location='query')
+    def get(self, page):
+        ''' Fetches a page of learning tasks, pass next_start_after as start_after for the next one '''
         child_id = session.get('child_id', None)  
         if child_id == None:
             return {"status":400,
                     "message": "Child_ID not found" }, 400 
-        list_of_tasks = list_all_learning_tasks(child_id)
+        try:
+            list_of_tasks, next_start_after = list_all_learning_tasks(child_id, **page)
+        except InvalidCursor as e:
+            return {"status":400, "message": str(e)}, 400
         return {"status":200, 
                 "message": "Successfully retrieved all tasks", 
-                "learning_tasks": list_of_tasks }
+                "learning_tasks": list_of_tasks,
+                "next_start_after": next_start_after }
 
     @common_learning_bp.response(status_code=201)
     @common_learning_bp.arguments(schema=LearningTaskPOSTSchema)
@@ -156,6 +170,105 @@ class LearningView(MethodView):
         return {"status":400, "message":mssg}
 
 
+# -----------------------------------------------------------------------
+# Batched Task Routes
+# -----------------------------------------------------------------------
+
+def validate_tasks(tasks: list, schema: Schema):
+    """ Loads every task with the single task schema.
+        Returns ([(index, params)], [result of every invalid task]) """
+    valid, invalid = [], []
+    for index, task in enumerate(tasks):
+        try:
+            valid.append((index, schema.load(task)))
+        except ValidationError as e:
+            invalid.append({"index": index, "task_id": task.get('task_id'), 
+                            "status": 422, "message": e.messages})
+    return valid, invalid
+
+def batch_response(results: list):
+    results = sorted(results, key=lambda result: result["index"])
+    failed = sum(1 for result in results if result["status"] >= 400)
+    return {"status":200, 
+            "message": f"{len(results) - failed} tasks succeeded, {failed} failed",
+            "results": results }
+
+def create_tasks(collection: str, task_class, schema: Schema, tasks: list):
+    child_id = session.get('child_id', None)  
+    if child_id == None:
+        return {"status":400,
+                "message": "Child_ID not found" }, 400
+    valid, invalid = validate_tasks(tasks, schema)
+    results = batch_add_tasks(child_id, collection, 
+                              [(index, task_class.from_dict(params).to_dict()) for index, params in valid])
+    return batch_response(invalid + results)
+
+def update_tasks(collection: str, task_class, schema: Schema, tasks: list):
+    child_id = session.get('child_id', None)  
+    if child_id == None:
+        return {"status":400,
+                "message": "Child_ID not found" }, 400
+    valid, invalid = validate_tasks(tasks, schema)
+    updates = []
+    for index, params in valid:
+        task_id = params.pop('task_id')
+        updates.append((index, task_id, task_class.from_dict(params).to_dict()))
+    return batch_response(invalid + batch_update_tasks(child_id, collection, updates))
+
+def delete_tasks(collection: str, schema: Schema, tasks: list):
+    child_id = session.get('child_id', None)  
+    if child_id == None:
+        return {"status":400,
+                "message": "Child_ID not found" }, 400
+    valid, invalid = validate_tasks(tasks, schema)
+    results = batch_delete_tasks(child_id, collection, 
+                                 [(index, params['task_id']) for index, params in valid])
+    return batch_response(invalid + results)
+
+@common_habitual_bp.route("/batch")
+class HabitualBatchView(MethodView):
+
+    @common_habitual_bp.response(status_code=200)
+    @common_habitual_bp.arguments(schema=TaskBatchSchema)
+    def post(self, params):
+        '''Creating many Habitual tasks for the Child by the Parent, results are per task'''
+        return create_tasks(HABITUAL_TASKS_COLLECTION_NAME, HabitualTask, HabitualTaskPOSTSchema(), params['tasks'])
+
+    @common_habitual_bp.response(status_code=200)
+    @common_habitual_bp.arguments(schema=TaskBatchSchema)
+    def put(self, params):
+        '''Updating many Habitual tasks for the Child by the Parent, results are per task'''
+        return update_tasks(HABITUAL_TASKS_COLLECTION_NAME, HabitualTask, HabitualTaskPUTSchema(), params['tasks'])
+
+    @common_habitual_bp.response(status_code=200)
+    @common_habitual_bp.arguments(schema=TaskBatchSchema)
+    def delete(self, params):
+        '''Deleting many Habitual tasks for the Child by the Parent, results are per task'''
+        return delete_tasks(HABITUAL_TASKS_COLLECTION_NAME, HabitualTaskDELSchema(), params['tasks'])
+
+
+@common_learning_bp.route("/batch")
+class LearningBatchView(MethodView):
+
+    @common_learning_bp.response(status_code=200)
+    @common_learning_bp.arguments(schema=TaskBatchSchema)
+    def post(self, params):
+        '''Creating many Learning tasks for the Child by the Parent, results are per task'''
+        return create_tasks(LEARNING_TASKS_COLLECTION_NAME, LearningTask, LearningTaskPOSTSchema(), params['tasks'])
+
+    @common_learning_bp.response(status_code=200)
+    @common_learning_bp.arguments(schema=TaskBatchSchema)
+    def put(self, params):
+        '''Updating many Learning tasks for the Child by the Parent, results are per task'''
+        return update_tasks(LEARNING_TASKS_COLLECTION_NAME, LearningTask, LerningTaskPUTSchema(), params['tasks'])
+
+    @common_learning_bp.response(status_code=200)
+    @common_learning_bp.arguments(schema=TaskBatchSchema)
+    def delete(self, params):
+        '''Deleting many Learning tasks for the Child by the Parent, results are per task'''
+        return delete_tasks(LEARNING_TASKS_COLLECTION_NAME, LearningTaskDELSchema(), params['tasks'])
+
+
 # -----------------------------------------------------------------------
 # Child information Related Routes
 # -----------------------------------------------------------------------
@@ -187,3 +300,64 @@ class ChildDetailsPOST(MethodView):
             return {"status":404,
                     "message": "Child Document not Found" }, 404
 
+
+@common_bp.route("/points_ledger")
+class PointsLedgerView(MethodView):
+    @common_bp.response(status_code=200)
+    def get(self):
+        '''Lists the points awarded to the child for completed tasks, latest first'''
+        child_id = session.get('child_id', None)  
+        if child_id == None:
+            return {"status":400,
+                    "message": "Child_ID not found" }, 400 
+        return {"status":200, 
+                "message": "Successfully retrieved the points ledger", 
+                "points_ledger": list_points_ledger(child_id) }
+
+
+@common_bp.route("/stress_summary/refresh")
+class StressSummaryRefreshView(MethodView):
+    @common_bp.response(status_code=200)
+    def post(self):
+        '''Rewrites the stress summary of the child from the recent conversations now,
+        instead of waiting for the next scheduled refresh'''
+        child_id = session.get('child_id', None)  
+        if child_id == None:
+            return {"status":400,
+                    "message": "Child_ID not found" }, 400 
+        try:
+            refreshed, mssg = refresh_stress_narrative(child_id)
+        except Exception as e:
+            return {"status":500, "message": str(e)}, 500
+        if refreshed:
+            return {"status":200, "message":mssg}
+        return {"status":404, "message":mssg}, 404
+
+
+# -----------------------------------------------------------------------
+# Readiness Route
+# -----------------------------------------------------------------------
+
+@common_bp.route("/ready")
+class ReadyView(MethodView):
+    @common_bp.response(status_code=200)
+    def get(self):
+        '''Reports whether the models have been warmed up and the worker can take traffic'''
+        state = get_warmup_state()
+        if state["status"] == "failed":
+            return {"status":503, "message":f"Warmup failed after {state['attempts']} attempts: {state['error']}"}, 503
+        if state["status"] != "ready":
+            return {"status":503, "message":"Warming up"}, 503
+        return {"status":200, "message":"Ready"}
+
+
+# ---------------------
+# DEV ONLY Routes
+# ---------------------
+
+@common_bp.route("/cache_stats")
+class CacheStatsView(MethodView):
+    @common_bp.response(status_code=200)
+    def get(self):
+        '''hit/miss counters of the child document cache per key type'''
+        return {"status":200, "firestore_cache": get_cache_stats()}
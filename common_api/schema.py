@@ -1,7 +1,27 @@
-from marshmallow import Schema, fields
+from marshmallow import Schema, fields, post_load, validate
+from webargs.fields import DelimitedList
 
 
 
+# ---------------------------
+# Query schema of paginated listings
+# ---------------------------
+class PageSchema(Schema):
+    page_size = fields.Int(missing=20, validate=validate.Range(min=1, max=100))
+    # Cursor returned as next_start_after by the previous page
+    start_after = fields.Str(missing=None)
+    # Comma separated fields to return, all of them if missing. Named
+    # projection here as Schema.fields is taken by marshmallow. Only plain 
+    # top level names, Firestore rejects other field paths in select()
+    projection = DelimitedList(fields.Str(validate=validate.Regexp(r"^[A-Za-z_][A-Za-z0-9_]*$", 
+                                                                   error="Invalid field name {input}")),
+                               data_key="fields", missing=None)
+
+    @post_load
+    def rename_projection(self, data, **kwargs):
+        data["fields"] = data.pop("projection")
+        return data
+
 # ---------------------------
 # Schemas for /common/habitual
 # ---------------------------
@@ -43,6 +63,17 @@ class LerningTaskPUTSchema(Schema):
 class LearningTaskDELSchema(Schema):
     task_id = fields.Str(required=True)
 
+# ---------------------------
+# Schemas for /common/habitual/batch and /common/learning/batch
+# ---------------------------
+# Tasks accepted by one batch request
+MAX_BATCH_TASKS = 500
+
+class TaskBatchSchema(Schema):
+    # Every item is validated on its own with the single task schema
+    # of the method, so one bad task does not reject the others
+    tasks = fields.List(fields.Dict(), required=True, validate=validate.Length(min=1, max=MAX_BATCH_TASKS))
+
 # ---------------------------
 # Schemas for /common/child_details
 # ---------------------------
@@ -4,7 +4,7 @@ import os
 load_dotenv()
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-UPLOAD_FOLDER = 'uploads'
+GEMINI_MODEL_NAME = "gemini-1.5-flash"
 GCP_KEY = "gcp_key.json"
 PROJECT_ID = "projects-aritro"
 
@@ -12,12 +12,111 @@ CHILD_COLLECTION_NAME = "children"
 CONV_COLLECTION_NAME = "conversations"
 HABITUAL_TASKS_COLLECTION_NAME = "habitual"
 LEARNING_TASKS_COLLECTION_NAME = "learning"
+# Points awarded per completed task, a subcollection of the child
+POINTS_LEDGER_COLLECTION_NAME = "points_ledger"
+# Username -> child_id index, the document id is the username
+USERNAME_COLLECTION_NAME = "usernames"
+# A stale Redis mirror of the index (e.g. a failed delete of a released username) expires after this
+USERNAME_MIRROR_TTL_SECONDS = 60 * 60
 
 REDIS_SERVER_HOST="localhost"
 REDIS_SERVER_PORT=6379
 
+# Background jobs (see jobs.py and worker.py)
+END_CHAT_QUEUE = "end_chat"
+END_CHAT_WORKER_CONCURRENCY = int(os.getenv("END_CHAT_WORKER_CONCURRENCY", 4))
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BACKOFF_SECONDS = 5
+JOB_RESULT_TTL_SECONDS = 24 * 60 * 60
+
+# Read-through Redis cache of child documents (see firestore_cache.py)
+FIRESTORE_CACHE_ENABLED = os.getenv("FIRESTORE_CACHE_ENABLED", "1") == "1"
+CHILD_CACHE_TTL_SECONDS = 15 * 60
+CHAT_SUMMARY_CACHE_TTL_SECONDS = 15 * 60
+PARENT_CHILD_CACHE_TTL_SECONDS = 60 * 60
+
 APP_HOST="0.0.0.0"
 
+# Threads running the independent stages (transcription, emotion) of voice turns
+VOICE_STAGE_WORKERS = int(os.getenv("VOICE_STAGE_WORKERS", 8))
+# Minimum characters of reply text synthesized at once by /child/voice_chat_stream
+STREAM_MIN_CHUNK_CHARS = 40
+
+# Voice chat history compaction (see child_api/history.py), a turn is a user and model message
+HISTORY_KEEP_TURNS = 6
+HISTORY_TOKEN_BUDGET = 1500
+HISTORY_FOLD_TTL_SECONDS = 24 * 60 * 60
+# An abandoned voice chat (see child_api/conversation_store.py) expires this long after its last turn
+CONVERSATION_TTL_SECONDS = 24 * 60 * 60
+
+# Live Gemini chat sessions reused across the turns of a voice or parent chat (see child_api/gemini.py)
+GEMINI_SESSION_CACHE_ENABLED = os.getenv("GEMINI_SESSION_CACHE_ENABLED", "1") == "1"
+GEMINI_SESSION_CACHE_ITEMS = 500
+GEMINI_SESSION_CACHE_BYTES = 16 * 1024 * 1024
+GEMINI_SESSION_CACHE_TTL_SECONDS = 30 * 60
+
+# Parent text chat history kept server side (see parent_api/chat_store.py), a turn is a user and model message
+PARENT_CHAT_KEEP_TURNS = 20
+# Turns allowed over the limit before trimming, a trim rebuilds the cached Gemini session
+PARENT_CHAT_TRIM_SLACK_TURNS = 5
+PARENT_CHAT_TTL_SECONDS = 24 * 60 * 60
+
+# Answers reused for near-duplicate parent questions (see parent_api/answer_cache.py)
+PARENT_ANSWER_CACHE_ENABLED = os.getenv("PARENT_ANSWER_CACHE_ENABLED", "0") == "1"
+PARENT_ANSWER_CACHE_THRESHOLD = float(os.getenv("PARENT_ANSWER_CACHE_THRESHOLD", 0.8))
+PARENT_ANSWER_CACHE_MAX_HISTORY_TURNS = 0
+PARENT_ANSWER_CACHE_ITEMS = 2000
+PARENT_ANSWER_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Cache of synthesized speech for short, repeated replies (see child_api/tts_cache.py)
+TTS_CACHE_ENABLED = os.getenv("TTS_CACHE_ENABLED", "1") == "1"
+TTS_CACHE_MAX_TEXT_CHARS = 200
+TTS_CACHE_MEMORY_BYTES = 32 * 1024 * 1024
+TTS_CACHE_REDIS_ITEMS = 5000
+TTS_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Speech emotion recognition model and backend (pytorch / quantized / onnx, see child_api/ser_backends.py)
+SER_MODEL_NAME = "ehcalabres/wav2vec2-lg-xlsr-en-speech-emotion-recognition"
+SER_BACKEND = os.getenv("SER_BACKEND", "pytorch")
+SER_ONNX_PATH = os.getenv("SER_ONNX_PATH", "models/ser.onnx")
+
+# Windowed emotion inference, long clips are classified in overlapping windows
+SER_WINDOWING_ENABLED = os.getenv("SER_WINDOWING_ENABLED", "1") == "1"
+SER_WINDOW_SECONDS = 4.0
+SER_WINDOW_HOP_SECONDS = 2.0
+# Shorter windows are zero padded, wav2vec2 needs at least 25ms of audio
+SER_MIN_WINDOW_SECONDS = 0.5
+# The X-Emotion-Timeline header of /child/voice_chat carries at most this many 
+# windows (evenly downsampled), the stream route sends the full timeline
+EMOTION_TIMELINE_HEADER_MAX_WINDOWS = 20
+
+# Warmup of the models and clients when the app starts, reported by /common/ready
+#   off        - load everything lazily on first use, ready immediately
+#   background - warm up in a thread, not ready until it finishes
+#   blocking   - warm up before serving (use with preloading servers so workers fork warm)
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "off")
+# A failed warmup is retried with a growing delay before it is reported as failed
+MODEL_WARMUP_RETRIES = int(os.getenv("MODEL_WARMUP_RETRIES", 3))
+MODEL_WARMUP_RETRY_SECONDS = 10
+
+# Micro batching of speech emotion recognition requests (see child_api/ser_batcher.py)
+SER_BATCHING_ENABLED = os.getenv("SER_BATCHING_ENABLED", "1") == "1"
+SER_MAX_BATCH_SIZE = int(os.getenv("SER_MAX_BATCH_SIZE", 8))
+SER_MAX_WAIT_MS = float(os.getenv("SER_MAX_WAIT_MS", 20))
+
+# End of chat analysis mode
+#   sequential - one Gemini call per field, one after another
+#   parallel   - one Gemini call per field, run concurrently
+#   structured - a single schema constrained JSON call, per field prompts as fallback
+CONV_ANALYSIS_MODE = os.getenv("CONV_ANALYSIS_MODE", "parallel")
+CONV_ANALYSIS_WORKERS = int(os.getenv("CONV_ANALYSIS_WORKERS", 8))
+# Running chat summary of a child: stress reasons kept for the narrative, 
+# which Gemini rewrites every STRESS_NARRATIVE_EVERY conversations
+RECENT_STRESS_SIZE = int(os.getenv("RECENT_STRESS_SIZE", 10))
+STRESS_NARRATIVE_EVERY = int(os.getenv("STRESS_NARRATIVE_EVERY", 5))
+if RECENT_STRESS_SIZE < 1 or STRESS_NARRATIVE_EVERY < 1:
+    raise ValueError("RECENT_STRESS_SIZE and STRESS_NARRATIVE_EVERY must be at least 1")
+
 class APIConfig:
     API_TITLE = "SaathiAPI"
     API_VERSION = "0.0.1"
@@ -1,12 +1,21 @@
+import base64
+import re
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import firebase_admin
 from firebase_admin import credentials
+from google.api_core.exceptions import Conflict
 from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
 
 from collections import Counter
-from child_api.helper import call_gemini
-from config import CHILD_COLLECTION_NAME, CONV_COLLECTION_NAME, GCP_KEY, HABITUAL_TASKS_COLLECTION_NAME, LEARNING_TASKS_COLLECTION_NAME, PROJECT_ID
+import firestore_cache
+from redis_store import redis
+from child_api.gemini import call_gemini, call_gemini_json, call_gemini_plain
+from config import CHILD_COLLECTION_NAME, CONV_ANALYSIS_MODE, RECENT_STRESS_SIZE, STRESS_NARRATIVE_EVERY, CONV_ANALYSIS_WORKERS, CONV_COLLECTION_NAME, GCP_KEY, HABITUAL_TASKS_COLLECTION_NAME, LEARNING_TASKS_COLLECTION_NAME, POINTS_LEDGER_COLLECTION_NAME, PROJECT_ID, USERNAME_COLLECTION_NAME, USERNAME_MIRROR_TTL_SECONDS
 from firestore_schema import Child, ConversationSummary, HabitualTask, LearningTask
 from firestore_schema import Conversation
 
@@ -15,6 +24,53 @@ firebase_admin.initialize_app(cred)
 
 db = firestore.Client(project = PROJECT_ID) 
 
+# -----------------------------------------------------------------
+# Pagination
+#
+# Listings return one page of documents and an opaque cursor to pass as
+# start_after for the next page, None after the last one. The cursor
+# holds the id of the last document, the query restarts after its
+# snapshot so any order_by keeps working. fields selects a projection.
+# -----------------------------------------------------------------
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(doc_id: str):
+    return base64.urlsafe_b64encode(json.dumps({"after": doc_id}).encode()).decode()
+
+def decode_cursor(cursor: str):
+    """ Document id held by a cursor, a single path segment """
+    try:
+        doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))["after"]
+    except Exception:
+        raise InvalidCursor("Invalid start_after cursor")
+    if not isinstance(doc_id, str) or not doc_id or "/" in doc_id:
+        raise InvalidCursor("Invalid start_after cursor")
+    return doc_id
+
+def fetch_page(collection_ref, query, 
+               page_size: Optional[int] = None, 
+               start_after: Optional[str] = None, 
+               fields: Optional[List[str]] = None):
+    """ (document snapshots of the page, cursor of the next page or None) """
+    if fields:
+        query = query.select(fields)
+    if start_after:
+        last_doc = collection_ref.document(decode_cursor(start_after)).get()
+        if not last_doc.exists:
+            raise InvalidCursor("The start_after document no longer exists")
+        query = query.start_after(last_doc)
+    if page_size:
+        # One more document tells whether there is a next page
+        query = query.limit(page_size + 1)
+
+    docs = list(query.stream())
+    if page_size and len(docs) > page_size:
+        docs = docs[:page_size]
+        return docs, encode_cursor(docs[-1].id)
+    return docs, None
+
 # -----------------------------------------------------------------
 # Child Helper Functions
 # -----------------------------------------------------------------
@@ -36,33 +92,68 @@ def update_child_entry(child_id: str, child: Child):
         # Check if the document exists
         if ref.get().exists:
             ref.update(child.to_dict())
+            firestore_cache.invalidate(child_id, "child", "chat_summary")
             return (f"Child with ID: {child_id} updated successfully.")
 
         return (f"Child {child_id} does not exist")
     except Exception as e:
         return (f"Exception occured while updating: {str(e)}")
 
+def split_child_document(child_dict: Dict):
+    """ (child dict without password and chat_summary, chat_summary) of a document """
+    child_dict = dict(child_dict)
+    child_dict.pop('password', None)
+    chat_summary = child_dict.pop('chat_summary', None)
+    return child_dict, chat_summary
+
+def cache_child_document(child_id: str, child_dict: Dict, chat_summary: Optional[Dict]):
+    firestore_cache.put("child", child_id, child_dict)
+    # Wrapped so a child without a summary yet is a hit as well
+    firestore_cache.put("chat_summary", child_id, {"chat_summary": chat_summary})
+
+def read_child_document(child_id: str, cached: bool = True):
+    """ (child dict without password and chat_summary, chat_summary) read through 
+        the cache, None if the child does not exist """
+    if cached:
+        child_dict = firestore_cache.get("child", child_id)
+        summary = firestore_cache.get("chat_summary", child_id)
+        if child_dict is not None and summary is not None:
+            return child_dict, summary["chat_summary"]
+
+    doc = db.collection(CHILD_COLLECTION_NAME).document(child_id).get()
+    if not doc.exists:
+        return None
+    child_dict, chat_summary = split_child_document(doc.to_dict())
+    cache_child_document(child_id, child_dict, chat_summary)
+    return child_dict, chat_summary
+
 def get_child_entry(child_id:Optional[str] = None, 
                     parent_uuid:Optional[str] = None):
     try:
         if parent_uuid:
-            query = db.collection(CHILD_COLLECTION_NAME).where("parent_uuid","==",parent_uuid)
-            docs = query.stream()
-            for doc in docs:
-                # Return the first matching document as a dictionary.
-                child_dict = doc.to_dict()
-                return (child_dict, doc.id)
-            
-            return None
+            cached_child_id = firestore_cache.get("parent_child", parent_uuid)
+            if cached_child_id:
+                child_id = cached_child_id
+            else:
+                query = db.collection(CHILD_COLLECTION_NAME).where("parent_uuid","==",parent_uuid)
+                docs = query.stream()
+                for doc in docs:
+                    # Return the first matching document as a dictionary.
+                    child_dict, chat_summary = split_child_document(doc.to_dict())
+                    firestore_cache.put("parent_child", parent_uuid, doc.id)
+                    cache_child_document(doc.id, child_dict, chat_summary)
+                    if chat_summary is not None:
+                        child_dict['chat_summary'] = chat_summary
+                    return (child_dict, doc.id)
+                
+                return None
 
-        elif child_id:
-            ref = db.collection(CHILD_COLLECTION_NAME).document(child_id)
-            # Check if the document exists
-            if ref.get().exists:
-                print(f"Child {child_id} exists.")
-                child_dict = ref.get().to_dict()
-                if 'password' in child_dict:
-                    del child_dict['password']
+        if child_id:
+            ret = read_child_document(child_id)
+            if ret:
+                child_dict, chat_summary = ret
+                if chat_summary is not None:
+                    child_dict['chat_summary'] = chat_summary
                 return ( child_dict, child_id )
 
             print(f"Child {child_id} does not exist.")
@@ -70,31 +161,118 @@ def get_child_entry(child_id:Optional[str] = None,
     except Exception as e:
         return (f"Exception occured while fetching child details: {str(e)}")
 
+# -----------------------------------------------------------------
+# Username index
+#   usernames/<username>   {"child_id": ...}, the source of truth. Written in
+#                          the same transaction as the child's credentials so
+#                          two children can never claim the same username
+#   username:<username>    Redis mirror of the child_id, filled on lookup and
+#                          expiring after USERNAME_MIRROR_TTL_SECONDS. Only a 
+#                          hint, login checks the username on the child itself
+# -----------------------------------------------------------------
+
+class UsernameTaken(Exception):
+    pass
+
+def username_mirror_key(username: str):
+    return f"username:{username}"
+
+def lookup_username(username: str):
+    """ child_id owning a username or None, one key lookup """
+    try:
+        child_id = redis.get(username_mirror_key(username))
+        if child_id is not None:
+            return child_id.decode()
+    except Exception as e:
+        print("Username mirror unavailable: ", str(e))
+
+    doc = db.collection(USERNAME_COLLECTION_NAME).document(username).get()
+    if not doc.exists:
+        return None
+    child_id = doc.to_dict()["child_id"]
+    try:
+        redis.set(username_mirror_key(username), child_id, ex=USERNAME_MIRROR_TTL_SECONDS)
+    except Exception as e:
+        print("Username mirror unavailable: ", str(e))
+    return child_id
+
+@firestore.transactional
+def claim_username(transaction, child_id: str, username: str, password: str):
+    """ Points the username at the child and updates the child's credentials,
+        releasing its previous username. Returns the previous username """
+    child_ref = db.collection(CHILD_COLLECTION_NAME).document(child_id)
+    index_ref = db.collection(USERNAME_COLLECTION_NAME).document(username)
+
+    # Every read of a transaction comes before its writes
+    child_doc = child_ref.get(transaction=transaction)
+    index_doc = index_ref.get(transaction=transaction)
+    if not child_doc.exists:
+        raise ValueError(f"Child {child_id} does not exist")
+    if index_doc.exists and index_doc.to_dict().get("child_id") != child_id:
+        raise UsernameTaken(username)
+
+    old_username = child_doc.to_dict().get("username")
+    if old_username and old_username != username:
+        transaction.delete(db.collection(USERNAME_COLLECTION_NAME).document(old_username))
+    transaction.set(index_ref, {"child_id": child_id})
+    transaction.update(child_ref, {"username": username, "password": password})
+    return old_username
+
+def update_child_credentials(child_id: str, username: str, password: str):
+    """ Sets the username and password of a child, failing if another child has the username """
+    try:
+        old_username = claim_username(db.transaction(), child_id, username, password)
+    except UsernameTaken:
+        return (False, "Username exists already")
+    except Exception as e:
+        return (False, f"Exception occured while updating: {str(e)}")
+
+    firestore_cache.invalidate(child_id, "child", "chat_summary")
+    try:
+        if old_username and old_username != username:
+            redis.delete(username_mirror_key(old_username))
+        redis.set(username_mirror_key(username), child_id, ex=USERNAME_MIRROR_TTL_SECONDS)
+    except Exception as e:
+        print("Username mirror unavailable: ", str(e))
+    return (True, f"Child with ID: {child_id} updated successfully.")
+
+def backfill_username_index():
+    """ Indexes the username of every existing child. Returns (indexed, conflicting usernames) """
+    indexed, conflicts = 0, []
+    docs = db.collection(CHILD_COLLECTION_NAME).select(["username"]).stream()
+    for doc in docs:
+        username = doc.to_dict().get("username")
+        if not username:
+            continue
+        index_ref = db.collection(USERNAME_COLLECTION_NAME).document(username)
+        try:
+            # create() fails if another child already owns the username
+            index_ref.create({"child_id": doc.id})
+        except Conflict:
+            owner = index_ref.get().to_dict().get("child_id")
+            if owner != doc.id:
+                conflicts.append(username)
+                continue
+        redis.set(username_mirror_key(username), doc.id, ex=USERNAME_MIRROR_TTL_SECONDS)
+        indexed += 1
+    return indexed, conflicts
+
 def check_username_password(username: str, password: str):
     try:
-        # Query the "Children" collection where "username" equals the provided username.
-        query = db.collection(CHILD_COLLECTION_NAME).where("username", "==", username)
-        docs = query.stream()
-        for doc in docs:
-            # Return the first matching document as a dictionary.
-            child_dict = doc.to_dict()
-            if password.strip() == child_dict.get('password',''):
-                return ("Logged in Successfully", doc.id)
+        child_id = lookup_username(username)
+        if child_id is None:
+            return ("Invalid Credentials", None)
+
+        # The mirror may still point a released username at its old child
+        doc = db.collection(CHILD_COLLECTION_NAME).document(child_id).get()
+        if doc.exists:
+            child = doc.to_dict()
+            if child.get('username') == username and password.strip() == child.get('password',''):
+                return ("Logged in Successfully", child_id)
         
         return ("Invalid Credentials", None)
     except Exception as e:
         return (f"Exception occured while logging in: {str(e)}", None)
-
-def check_username_exists(username: str):
-    try:
-        query = db.collection(CHILD_COLLECTION_NAME).where("username", "==", username)
-        docs = query.stream()
-        for _ in docs:
-            return True
-        return False
-    except Exception as e:
-        print(f"Exception occured while checking username: {str(e)}")
-        return True
     
 # -----------------------------------------------------------------
 # Conversation Helper Functions
@@ -107,25 +285,143 @@ stress_reason_prompt = "Based on the chat history can you answer in 30 words why
 stress_summary_prompt = "Can you state a crisp reason for stress from the following messages and write \"No Stress\" if there is none."
 
 
+structured_analysis_prompt = "Analyse the chat history so far and fill in every field of the JSON response. The user is the child, not you."
+
+# Field name -> prompt used to extract it on its own
+analysis_prompts = {
+    "summary": summarize_prompt,
+    "interests": positive_prompt,
+    "stress": stress_prompt,
+    "stress_reason": stress_reason_prompt,
+}
+
+# Schema for extracting every field in a single call
+analysis_schema = {
+    "type": "OBJECT",
+    "properties": {
+        field: {"type": "STRING", "description": prompt}
+        for field, prompt in analysis_prompts.items()
+    },
+    "required": list(analysis_prompts.keys()),
+}
+
+stress_levels = ["Stressless", "Low", "Moderate", "High"]
+
+# Bounded pool shared by every end of chat request, so concurrent 
+# conversations cannot open an unbounded number of Gemini calls
+analysis_executor = ThreadPoolExecutor(max_workers=CONV_ANALYSIS_WORKERS,
+                                       thread_name_prefix="conv-analysis")
+
+# Running latency totals of the analysis step per mode, kept in Redis as
+# the analysis runs in the end of chat worker, not in the app serving
+# /child/analysis_timings.  analysis_timings:<mode> {runs, total_seconds}
+ANALYSIS_TIMINGS_PREFIX = "analysis_timings:"
+analysis_modes = ["sequential", "parallel", "structured", "structured_fallback"]
+
+
 def most_frequent(lst):
     return Counter(lst).most_common(1)[0][0]
 
+def record_analysis_timing(mode: str, elapsed: float):
+    print(f"Conversation analysis [{mode}] took {elapsed:.2f}s")
+    try:
+        pipe = redis.pipeline()
+        pipe.hincrby(ANALYSIS_TIMINGS_PREFIX + mode, "runs", 1)
+        pipe.hincrbyfloat(ANALYSIS_TIMINGS_PREFIX + mode, "total_seconds", elapsed)
+        pipe.execute()
+    except Exception as e:
+        print("Could not record the analysis timing: ", str(e))
+
+def get_analysis_timings():
+    """ Returns the mean latency of the analysis step per mode, over every worker """
+    pipe = redis.pipeline(transaction=False)
+    for mode in analysis_modes:
+        pipe.hgetall(ANALYSIS_TIMINGS_PREFIX + mode)
+    timings = {}
+    for mode, stats in zip(analysis_modes, pipe.execute()):
+        if not stats:
+            continue
+        runs, total_seconds = int(stats[b"runs"]), float(stats[b"total_seconds"])
+        timings[mode] = {"runs": runs, "total_seconds": total_seconds, 
+                         "mean_seconds": total_seconds / runs}
+    return timings
+
+def analyse_conversation_per_field(chat_history: List, concurrent: bool = True):
+    """ Asks Gemini for every field with its own prompt. 
+        Each call gets its own copy of the history as call_gemini may modify it """
+    if not concurrent:
+        return { field: call_gemini(prompt, list(chat_history), None)
+                 for field, prompt in analysis_prompts.items() }
+
+    futures = { field: analysis_executor.submit(call_gemini, prompt, list(chat_history), None)
+                for field, prompt in analysis_prompts.items() }
+    return { field: future.result() for field, future in futures.items() }
+
+def analyse_conversation_structured(chat_history: List):
+    """ Asks Gemini for every field in a single JSON reply.
+        Returns None if the reply could not be used """
+    try:
+        analysis = call_gemini_json(structured_analysis_prompt, list(chat_history), analysis_schema)
+    except Exception as e:
+        print("Structured analysis failed: ", str(e))
+        return None
+
+    if not isinstance(analysis, dict) or \
+        not all(isinstance(analysis.get(field), str) for field in analysis_prompts):
+        print("Structured analysis returned an incomplete response: ", analysis)
+        return None
+    if analysis["stress"].strip().title() not in stress_levels:
+        print("Structured analysis returned an invalid stress level: ", analysis["stress"])
+        return None
+    analysis["stress"] = analysis["stress"].strip().title()
+    return analysis
+
+def analyse_conversation(chat_history: List, mode: str = CONV_ANALYSIS_MODE):
+    """ Extracts summary, interests, stress and stress_reason from the chat history
+        using the requested mode and records how long it took """
+    start = time.perf_counter()
+    analysis = None
+    if mode == "structured":
+        analysis = analyse_conversation_structured(chat_history)
+        if analysis is None:
+            mode = "structured_fallback"
+    if analysis is None:
+        analysis = analyse_conversation_per_field(chat_history, 
+                                                  concurrent = mode != "sequential")
+    record_analysis_timing(mode, time.perf_counter() - start)
+    return analysis
+
 def add_new_conversation(child_id:str, 
                          chat_history: List, 
                          emotion:List[str],
-                         duration: int
+                         duration: int,
+                         conversation_id: Optional[str] = None,
+                         created_at: Optional[datetime] = None
                          ):
+    """ Saves a finished chat as a conversation and adds it to the child summary.
+        With a conversation_id (the end of chat job id) saving is idempotent, a
+        retried job does not add the conversation twice. created_at is when the
+        chat ended, now if not given """
+    # Nothing is written for a child that does not exist
+    doc_ref = db.collection(CHILD_COLLECTION_NAME).document(child_id)
+    if not doc_ref.get(field_paths=[]).exists:
+        return (False, "Failed because child_id invalid")
+
+    conv_col_ref = db.collection(f"{CHILD_COLLECTION_NAME}/{child_id}/{CONV_COLLECTION_NAME}")
+    conv_ref = conv_col_ref.document(conversation_id) if conversation_id else conv_col_ref.document()
+    if conversation_id and conv_ref.get(field_paths=[]).exists:
+        return (True, "Conversation already saved")
+
     try:
-        # make API call to summarize chat_history
-        summary = call_gemini(summarize_prompt, chat_history, None)
-        # make API call to extract positive impacts (interests)
-        interests = call_gemini(positive_prompt, chat_history, None)
-        # make API call to extract stress level
-        stress = call_gemini(stress_prompt, chat_history, None)
+        # make API calls to summarize chat_history, extract positive impacts (interests),
+        # extract stress level and find possible reason for stress
+        analysis = analyse_conversation(chat_history)
+        summary = analysis["summary"]
+        interests = analysis["interests"]
+        stress = analysis["stress"]
         if len(stress) > 0:
             stress = stress.strip()
-        # make API call to find possible reason for stress
-        stress_reason = call_gemini(stress_reason_prompt, chat_history, None)
+        stress_reason = analysis["stress_reason"]
         # Checking which emotion is the most dominant in the conversation 
         dominant_emotion = most_frequent(emotion)
         if isinstance(dominant_emotion, str):
@@ -135,8 +431,7 @@ def add_new_conversation(child_id:str,
 
     # Stress is still left 
     conversation = Conversation(
-        date = datetime.today().date(), 
-        time = datetime.today().time(),
+        created_at = created_at or datetime.now(timezone.utc),
         interests=interests, 
         duration = duration,
         summary = summary,
@@ -145,85 +440,230 @@ def add_new_conversation(child_id:str,
         stressSummary=stress_reason
         )
 
+    # The conversation and the running child summary are written in one 
+    # transaction, a retry finding the conversation saved changes nothing
+    try:
+        conversations = update_chat_summary(db.transaction(), child_id, conv_ref, conversation.to_dict(),
+                                            duration, dominant_emotion, stress, stress_reason, interests)
+    except Exception as e:
+        return (False, str(e))
+    if conversations is None:
+        return (True, "Conversation already saved")
+    print("Conversation created successfully with refID: ", conv_ref.id)
+    firestore_cache.invalidate(child_id, "chat_summary")
 
-    doc_ref = db.collection(f"{CHILD_COLLECTION_NAME}/{child_id}/{CONV_COLLECTION_NAME}")
-    ref = doc_ref.add( conversation.to_dict() )
-
-    print("Conversation created successfully with refID: ", ref[1].id)
-
-    # Updating the child summary
+    # The narrative is rewritten from the recent reasons every few conversations only
+    if conversations % STRESS_NARRATIVE_EVERY == 0:
+        try:
+            refresh_stress_narrative(child_id)
+        except Exception as e:
+            print("Failed to refresh the stress narrative: ", str(e))
+    return (True, "successfully updated")
+
+def histogram_key(label: Optional[str]):
+    """ Label usable as a map key in a field path, Unknown otherwise """
+    label = (label or "").strip().strip(".").title()
+    return label if re.fullmatch(r"[A-Za-z_]+", label) else "Unknown"
+
+@firestore.transactional
+def update_chat_summary(transaction, child_id: str, conv_ref, conversation: Dict,
+                        duration: float, emotion: Optional[str], 
+                        stress: str, stress_reason: str, interests: str):
+    """ Creates the conversation and adds it to the running aggregates of the 
+        child's chat summary in constant time. Returns the number of 
+        conversations so far, or None if the conversation was already saved """
     doc_ref = db.collection(CHILD_COLLECTION_NAME).document(child_id)
-    doc = doc_ref.get()
-    if doc_ref.get().exists:
-        chat_summary = doc.to_dict().get("chat_summary") 
-        if chat_summary:
-            conv_sum = ConversationSummary.from_dict(chat_summary)
-            
-            # Updating the object
-            if conv_sum.conversations:
-                conv_sum.conversations = conv_sum.conversations + 1
-            conv_sum.last_updated = datetime.now()
-            conv_sum.stress = stress
-            conv_sum.stressSummary = call_gemini( stress_summary_prompt + conv_sum.stressSummary + stress_reason, [], None)
-            conv_sum.interests_summary = interests
-            conv_sum.emotion = dominant_emotion
-            if conv_sum.total_duration:
-                conv_sum.total_duration = conv_sum.total_duration + duration
-
-            # Storing it back
-            try:
-                doc_ref.update({"chat_summary":conv_sum.to_dict()})
-                return (True, "successfully updated")
-            except Exception as e:
-                return (False, str(e))
-
-        else:
-            print("Chat summary does not exist.. Creating one for the first time")
-            conv_sum = ConversationSummary(
-                        last_updated = datetime.now(),
-                        emotion = dominant_emotion, 
-                        conversations=1, 
-                        stress=stress,
-                        stressSummary=stress_reason,
-                        total_duration=duration,
-                        interests_summary=interests
-                    )
-            # Storing it back
-            try:
-                doc_ref.update({"chat_summary":conv_sum.to_dict()})
-                return (True, "successfully updated")
-            except Exception as e:
-                return (False, str(e))
-
-    else:
-        return (False, "Failed because child_id invalid")
+    doc = doc_ref.get(field_paths=["chat_summary.conversations", "chat_summary.total_duration",
+                                   "chat_summary.recent_stress", "chat_summary.stressSummary"], 
+                      transaction=transaction)
+    if not doc.exists:
+        raise ValueError("Failed because child_id invalid")
+    # The conversation document marks it as counted
+    if conv_ref.get(field_paths=[], transaction=transaction).exists:
+        return None
+    chat_summary = doc.to_dict().get("chat_summary") or {}
+
+    # Missing or zero counters of older summaries start from zero
+    conversations = (chat_summary.get("conversations") or 0) + 1
+    total_duration = (chat_summary.get("total_duration") or 0) + (duration or 0)
+    recent_stress = [{"stress": stress, "reason": stress_reason}] + (chat_summary.get("recent_stress") or [])
+
+    latest = ConversationSummary(last_updated = datetime.now(),
+                                 emotion = emotion,
+                                 stress = stress,
+                                 interests_summary = interests,
+                                 mean_duration = total_duration / conversations,
+                                 recent_stress = recent_stress[:RECENT_STRESS_SIZE]).to_dict()
+    if not chat_summary.get("stressSummary"):
+        latest["stressSummary"] = stress_reason
+
+    update = {f"chat_summary.{field}": value for field, value in latest.items()}
+    update["chat_summary.conversations"] = firestore.Increment(1)
+    update["chat_summary.total_duration"] = firestore.Increment(duration or 0)
+    update[f"chat_summary.emotion_histogram.{histogram_key(emotion)}"] = firestore.Increment(1)
+    update[f"chat_summary.stress_histogram.{histogram_key(stress)}"] = firestore.Increment(1)
+    transaction.create(conv_ref, conversation)
+    transaction.update(doc_ref, update)
+    return conversations
+
+def refresh_stress_narrative(child_id: str):
+    """ Rewrites the stress narrative of the chat summary from the recent stress reasons """
+    doc_ref = db.collection(CHILD_COLLECTION_NAME).document(child_id)
+    doc = doc_ref.get(field_paths=["chat_summary.recent_stress"])
+    if not doc.exists:
+        return (False, f"Child {child_id} does not exist")
+    recent_stress = (doc.to_dict().get("chat_summary") or {}).get("recent_stress")
+    if not recent_stress:
+        return (False, "No conversations to summarize")
+
+    reasons = "\n".join(f"- {entry['stress']}: {entry['reason']}" for entry in recent_stress)
+    narrative = call_gemini_plain(stress_summary_prompt + "\n" + reasons)
+    doc_ref.update({"chat_summary.stressSummary": narrative.strip()})
+    firestore_cache.invalidate(child_id, "chat_summary")
+    return (True, "Stress summary refreshed")
 
 def fetch_chat_summary(child_id:str):
     try:
-        ref = db.collection(CHILD_COLLECTION_NAME).document(child_id)
-        # Check if the document exists
-        if ref.get().exists:
-            print(f"Child {child_id} exists.")
-            child_dict = ref.get().to_dict()
-            if 'chat_summary' not in child_dict:
-                return None
-            return child_dict['chat_summary']
+        summary = firestore_cache.get("chat_summary", child_id)
+        if summary is not None:
+            return summary["chat_summary"]
+
+        ret = read_child_document(child_id, cached=False)
+        if ret is None:
+            return None
+        _, chat_summary = ret
+        return chat_summary
     except Exception as e:
         return None
 
-def fetch_all_conversations(child_id: str):
+def fetch_all_conversations(child_id: str, 
+                            page_size: Optional[int] = None, 
+                            start_after: Optional[str] = None, 
+                            fields: Optional[List[str]] = None,
+                            since: Optional[datetime] = None,
+                            until: Optional[datetime] = None):
+    """ (page of conversations latest first, cursor of the next page).
+        since / until limit created_at to a range """
+    collection_ref = db.collection(
+        f"{CHILD_COLLECTION_NAME}/{child_id}/{CONV_COLLECTION_NAME}"
+    )
+    # Sort by the timestamp in descending order (latest first), the range 
+    # and the order are on the same field so the built-in index serves both
+    query = collection_ref.order_by("created_at", direction=firestore.Query.DESCENDING)
+    if since:
+        query = query.where(filter=FieldFilter("created_at", ">=", since))
+    if until:
+        query = query.where(filter=FieldFilter("created_at", "<", until))
+    if fields and ("date" in fields or "time" in fields):
+        # The display strings are made from the timestamp
+        fields = list(fields) + ["created_at"]
+
     try:
-        collection_ref = db.collection(
-            f"{CHILD_COLLECTION_NAME}/{child_id}/{CONV_COLLECTION_NAME}"
-        )
+        docs, next_cursor = fetch_page(collection_ref, query, page_size, start_after, fields)
+        return [Conversation.display_dict(doc.to_dict()) for doc in docs], next_cursor
+    except InvalidCursor:
+        raise
+    except Exception as e:
+        print("Error fetching conversations:", e)
+        return [], None
+
+def backfill_conversation_timestamps(batch_size: int = 400, start_after: Optional[str] = None):
+    """ Rewrites conversations stored with date and time strings to a created_at
+        timestamp, one WriteBatch per page of conversations across every child.
+        Yields (documents read, documents updated, path of the last document)
+        after every committed page, pass that path as start_after to resume.
+        A document whose date or time cannot be parsed is logged and skipped """
+    query = db.collection_group(CONV_COLLECTION_NAME) \
+              .order_by(firestore.FieldPath.document_id()) \
+              .select(["created_at", "date", "time"]) \
+              .limit(batch_size)
+    if start_after:
+        query = query.start_after(db.document(start_after).get())
+
+    while True:
+        docs = list(query.stream())
+        if not docs:
+            return
+        batch = db.batch()
+        updated = 0
+        for doc in docs:
+            data = doc.to_dict()
+            if "created_at" in data:
+                continue
+            try:
+                created_at = Conversation.legacy_created_at(data)
+            except ValueError as e:
+                print(f"Skipping {doc.reference.path}, unparsable date/time: ", str(e))
+                continue
+            if created_at is None:
+                continue
+            batch.update(doc.reference, {"created_at": created_at,
+                                         "date": firestore.DELETE_FIELD,
+                                         "time": firestore.DELETE_FIELD})
+            updated += 1
+        if updated:
+            batch.commit()
+        yield len(docs), updated, docs[-1].reference.path
+        query = query.start_after(docs[-1])
 
-        # Sort by date field in descending order (latest first)
-        docs = collection_ref.order_by("date", direction=firestore.Query.DESCENDING).order_by("time", direction=firestore.Query.DESCENDING).stream()
+# -----------------------------------------------------------------
+# Task completion and points
+#
+# A task update and the points it awards are written in one transaction.
+# The first time a task is marked done its points are added to the child
+# with Increment and an entry <collection>:<task_id> is created in the
+# child's points ledger. The task keeps points_awarded so completing it
+# again, from another device or a retried request, adds nothing.
+# -----------------------------------------------------------------
 
-        return [doc.to_dict() for doc in docs]
+class TaskNotFound(Exception):
+    pass
+
+@firestore.transactional
+def apply_task_update(transaction, child_id: str, collection: str, task_id: str, task_dict: Dict):
+    """ Updates a task, awarding its points if this completes it. Returns the points awarded """
+    child_ref = db.collection(CHILD_COLLECTION_NAME).document(child_id)
+    task_ref = child_ref.collection(collection).document(task_id)
+
+    task_doc = task_ref.get(transaction=transaction)
+    if not task_doc.exists:
+        raise TaskNotFound(task_id)
+    task = {**task_doc.to_dict(), **task_dict}
+
+    awarded = 0
+    if task_dict.get('is_done') and not task.get('points_awarded'):
+        awarded = task.get('points') or 0
+        task_dict = {**task_dict, 'points_awarded': True}
+        transaction.update(child_ref, {'points': firestore.Increment(awarded)})
+        transaction.create(child_ref.collection(POINTS_LEDGER_COLLECTION_NAME).document(f"{collection}:{task_id}"),
+                           {'task_type': collection,
+                            'task_id': task_id,
+                            'title': task.get('title'),
+                            'points': awarded,
+                            'awarded_at': firestore.SERVER_TIMESTAMP})
+    transaction.update(task_ref, task_dict)
+    return awarded
+
+def update_task(child_id: str, collection: str, task_id: str, task_dict: Dict):
+    try:
+        awarded = apply_task_update(db.transaction(), child_id, collection, task_id, task_dict)
+    except TaskNotFound:
+        return (False, f"Task {task_id} does not exist")
     except Exception as e:
-        print("Error fetching conversations:", e)
-        return []
+        return (False, str(e))
+
+    if awarded:
+        firestore_cache.invalidate(child_id, "child")
+        return (True, f"Successfully updated task, awarded {awarded} points")
+    return (True, "Successfully updated task")
+
+def list_points_ledger(child_id: str):
+    """ Points awarded to a child, latest first """
+    docs = db.collection(CHILD_COLLECTION_NAME).document(child_id) \
+             .collection(POINTS_LEDGER_COLLECTION_NAME) \
+             .order_by('awarded_at', direction=firestore.Query.DESCENDING).stream()
+    return [doc.to_dict() for doc in docs]
+
 # -----------------------------------------------------------------
 # Habitual Tasks Helper Functions
 # -----------------------------------------------------------------
@@ -244,51 +684,27 @@ def add_habitual_task( child_id:str, ht: HabitualTask):
     except Exception as e:
         return ( False, str(e) )
 
-def list_all_habitual_tasks(child_id:str):
+def list_all_habitual_tasks(child_id:str, 
+                            page_size: Optional[int] = None, 
+                            start_after: Optional[str] = None, 
+                            fields: Optional[List[str]] = None):
+    """ (page of tasks in document id order, cursor of the next page) """
     collection_ref = db.collection(
             CHILD_COLLECTION_NAME+"/"+child_id+"/"+ HABITUAL_TASKS_COLLECTION_NAME)
 
-    # Fetch all documents
-    docs = collection_ref.stream()
+    docs, next_cursor = fetch_page(collection_ref, collection_ref.order_by(firestore.FieldPath.document_id()),
+                                   page_size, start_after, fields)
     list_of_tasks = []
     for doc in docs:
         doc_dict = doc.to_dict()
         doc_dict['task_id'] = doc.id
         list_of_tasks += [doc_dict]
 
-    return list_of_tasks
+    return list_of_tasks, next_cursor
 
 def update_habitual_task(child_id:str, task_id:str, ht:HabitualTask):
-    task_doc_ref = db.collection(
-            CHILD_COLLECTION_NAME+"/"+
-            child_id+"/"+ 
-            HABITUAL_TASKS_COLLECTION_NAME
-            ).document(task_id)
-    try:
-        task_dict = ht.to_dict()
-        task_doc_ref.update(task_dict)
-    except Exception as e:
-        return (False, str(e))
-
-    # If this is task being updated as done, add the points
-    if 'is_done' in task_dict and task_dict['is_done']:
-
-        # Fetch how many points
-        old_points = task_doc_ref.get().to_dict()['points']
+    return update_task(child_id, HABITUAL_TASKS_COLLECTION_NAME, task_id, ht.to_dict())
 
-        # Get how many points it had previously
-        try:
-            ret = get_child_entry(child_id=child_id)
-            if ret:
-                child_dict, _ = ret
-                if 'points' in child_dict:
-                    new_points = child_dict['points'] 
-                    update_child_entry(child_id, Child(points=old_points+new_points))
-
-        except Exception as e:
-            return (False, str(e))
-
-    return (True, "Successfully updated task")
 def delete_habitual_task(child_id:str, task_id:str):
     doc_ref = db.collection(
             CHILD_COLLECTION_NAME+"/"+
@@ -307,19 +723,23 @@ def delete_habitual_task(child_id:str, task_id:str):
 # Learning Tasks Helper Functions
 # -----------------------------------------------------------------
 
-def list_all_learning_tasks(child_id:str):
+def list_all_learning_tasks(child_id:str, 
+                            page_size: Optional[int] = None, 
+                            start_after: Optional[str] = None, 
+                            fields: Optional[List[str]] = None):
+    """ (page of tasks in document id order, cursor of the next page) """
     collection_ref = db.collection(
             CHILD_COLLECTION_NAME+"/"+child_id+"/"+ LEARNING_TASKS_COLLECTION_NAME)
 
-    # Fetch all documents
-    docs = collection_ref.stream()
+    docs, next_cursor = fetch_page(collection_ref, collection_ref.order_by(firestore.FieldPath.document_id()),
+                                   page_size, start_after, fields)
     list_of_tasks = []
     for doc in docs:
         doc_dict = doc.to_dict()
         doc_dict['task_id'] = doc.id
         list_of_tasks += [doc_dict]
 
-    return list_of_tasks
+    return list_of_tasks, next_cursor
 
 def add_learning_task( child_id:str, lt: LearningTask):
     try:
@@ -337,16 +757,7 @@ def add_learning_task( child_id:str, lt: LearningTask):
         return ( False, str(e) )
 
 def update_learning_task(child_id:str, task_id:str, lt:LearningTask):
-    doc_ref = db.collection(
-            CHILD_COLLECTION_NAME+"/"+
-            child_id+"/"+ 
-            LEARNING_TASKS_COLLECTION_NAME
-            ).document(task_id)
-    try:
-        doc_ref.update(lt.to_dict())
-        return (True, "Successfully updated task")
-    except Exception as e:
-        return (False, str(e))
+    return update_task(child_id, LEARNING_TASKS_COLLECTION_NAME, task_id, lt.to_dict())
 
 def delete_learning_task(child_id:str, task_id:str):
     doc_ref = db.collection(
@@ -362,3 +773,84 @@ def delete_learning_task(child_id:str, task_id:str):
         return (False, str(e))
 
 
+
+
+# -----------------------------------------------------------------
+# Batched Task Writes
+#
+# Many tasks written with WriteBatch commits of up to WRITE_BATCH_LIMIT
+# operations. A batch is atomic, so a failing commit fails every task of
+# its chunk. Results are per task: {"index", "task_id", "status", "message"}
+# -----------------------------------------------------------------
+
+# Maximum writes in one Firestore commit
+WRITE_BATCH_LIMIT = 500
+
+def task_collection(child_id: str, collection: str):
+    return db.collection(CHILD_COLLECTION_NAME).document(child_id).collection(collection)
+
+def commit_in_chunks(writes: List[Dict]):
+    """ Commits every write, a dict of index, task_id, apply(batch) and the
+        status on success, and returns its result """
+    results = []
+    for start in range(0, len(writes), WRITE_BATCH_LIMIT):
+        chunk = writes[start:start + WRITE_BATCH_LIMIT]
+        batch = db.batch()
+        for write in chunk:
+            write["apply"](batch)
+        try:
+            batch.commit()
+            status, message = None, None
+        except Exception as e:
+            status, message = 500, str(e)
+        results += [{"index": write["index"],
+                     "task_id": write["task_id"],
+                     "status": status or write["status"],
+                     "message": message or write["message"]} for write in chunk]
+    return results
+
+def batch_add_tasks(child_id: str, collection: str, tasks: List[Tuple[int, Dict]]):
+    """ Creates (index, task dict) pairs, ids are assigned before the commit """
+    collection_ref = task_collection(child_id, collection)
+    writes = []
+    for index, task_dict in tasks:
+        doc_ref = collection_ref.document()
+        writes.append({"index": index, "task_id": doc_ref.id, "status": 201, "message": "Task created",
+                       "apply": lambda batch, ref=doc_ref, data=task_dict: batch.set(ref, data)})
+    return commit_in_chunks(writes)
+
+def batch_update_tasks(child_id: str, collection: str, tasks: List[Tuple[int, str, Dict]]):
+    """ Updates (index, task_id, task dict) triples. A missing task fails its
+        chunk, so their existence is checked with one read first. Completions
+        go through update_task so their points are awarded exactly once.
+
+        The check and the commit are not atomic. An update only applies to an
+        existing document, so a task deleted in between is never recreated,
+        but it fails the rest of its chunk with a 500 """
+    if not tasks:
+        return []
+    collection_ref = task_collection(child_id, collection)
+    refs = [collection_ref.document(task_id) for _, task_id, _ in tasks]
+    existing = {doc.id for doc in db.get_all(refs, field_paths=[]) if doc.exists}
+
+    results, writes = [], []
+    for index, task_id, task_dict in tasks:
+        if task_id not in existing:
+            results.append({"index": index, "task_id": task_id, "status": 404,
+                            "message": f"Task {task_id} does not exist"})
+        elif task_dict.get('is_done'):
+            updated, message = update_task(child_id, collection, task_id, task_dict)
+            results.append({"index": index, "task_id": task_id, "status": 200 if updated else 500,
+                            "message": message})
+        else:
+            writes.append({"index": index, "task_id": task_id, "status": 200, "message": "Task updated",
+                           "apply": lambda batch, ref=collection_ref.document(task_id), data=task_dict: batch.update(ref, data)})
+    return sorted(results + commit_in_chunks(writes), key=lambda result: result["index"])
+
+def batch_delete_tasks(child_id: str, collection: str, tasks: List[Tuple[int, str]]):
+    """ Deletes (index, task_id) pairs, deleting a missing task succeeds """
+    collection_ref = task_collection(child_id, collection)
+    writes = [{"index": index, "task_id": task_id, "status": 200, "message": "Task deleted",
+               "apply": lambda batch, ref=collection_ref.document(task_id): batch.delete(ref)}
+              for index, task_id in tasks]
+    return commit_in_chunks(writes)
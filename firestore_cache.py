@@ -0,0 +1,95 @@
+import json
+from datetime import datetime
+from threading import Lock
+from typing import Any, Dict, Optional
+
+from config import (CHAT_SUMMARY_CACHE_TTL_SECONDS, CHILD_CACHE_TTL_SECONDS, FIRESTORE_CACHE_ENABLED,
+                    PARENT_CHILD_CACHE_TTL_SECONDS)
+from redis_store import redis
+
+# -----------------------------------------------------------------
+# Read-through cache in front of the child document reads of firestore.py.
+#   cache:child:<child_id>            child document, without password and chat_summary
+#   cache:chat_summary:<child_id>     chat_summary field of the child document
+#   cache:parent_child:<parent_uuid>  id of the child of a parent
+# Writes to a child document invalidate its keys, the TTLs only bound
+# how stale a missed invalidation can get. A Redis failure falls back
+# to Firestore.
+# -----------------------------------------------------------------
+
+ttls = {
+    "child": CHILD_CACHE_TTL_SECONDS,
+    "chat_summary": CHAT_SUMMARY_CACHE_TTL_SECONDS,
+    "parent_child": PARENT_CHILD_CACHE_TTL_SECONDS,
+}
+
+# Key type -> counters
+metrics: Dict[str, Dict[str, int]] = {
+    key_type: {"hits": 0, "misses": 0, "invalidations": 0, "errors": 0} for key_type in ttls
+}
+metrics_lock = Lock()
+
+
+def count(key_type: str, metric: str):
+    with metrics_lock:
+        metrics[key_type][metric] += 1
+
+def cache_key(key_type: str, id: str):
+    return f"cache:{key_type}:{id}"
+
+def encode(value: Any):
+    # Firestore timestamps come back as datetimes, kept as such through the cache
+    return json.dumps(value, default=lambda v: {"__datetime__": v.isoformat()}
+                      if isinstance(v, datetime) else str(v))
+
+def decode(data: bytes):
+    return json.loads(data, object_hook=lambda d: datetime.fromisoformat(d["__datetime__"])
+                      if d.keys() == {"__datetime__"} else d)
+
+def get(key_type: str, id: str) -> Optional[Any]:
+    """ Cached value or None on a miss """
+    if not FIRESTORE_CACHE_ENABLED:
+        return None
+    try:
+        data = redis.get(cache_key(key_type, id))
+    except Exception as e:
+        print("Firestore cache unavailable: ", str(e))
+        count(key_type, "errors")
+        return None
+    if data is None:
+        count(key_type, "misses")
+        return None
+    count(key_type, "hits")
+    return decode(data)
+
+def put(key_type: str, id: str, value: Any):
+    if not FIRESTORE_CACHE_ENABLED:
+        return
+    try:
+        redis.set(cache_key(key_type, id), encode(value), ex=ttls[key_type])
+    except Exception as e:
+        print("Firestore cache unavailable: ", str(e))
+        count(key_type, "errors")
+
+def invalidate(id: str, *key_types: str):
+    """ Drops the cached values of a document after it is written """
+    if not FIRESTORE_CACHE_ENABLED:
+        return
+    try:
+        redis.delete(*[cache_key(key_type, id) for key_type in key_types])
+    except Exception as e:
+        print("Firestore cache unavailable: ", str(e))
+        for key_type in key_types:
+            count(key_type, "errors")
+        return
+    for key_type in key_types:
+        count(key_type, "invalidations")
+
+def get_cache_stats():
+    """ Hit/miss counters and hit rate per key type """
+    with metrics_lock:
+        stats = {key_type: dict(counters) for key_type, counters in metrics.items()}
+    for counters in stats.values():
+        lookups = counters["hits"] + counters["misses"]
+        counters["hit_rate"] = counters["hits"] / lookups if lookups else None
+    return {"enabled": FIRESTORE_CACHE_ENABLED, "key_types": stats}
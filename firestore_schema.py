@@ -1,5 +1,5 @@
 from typing import Any, Dict, List, Optional, Union
-from datetime import datetime, date, time
+from datetime import datetime, date, time, timezone
 
 # ---------------------------
 # Domain Class: Child 
@@ -59,7 +59,12 @@ class Child:
 # Domain Class: Conversation
 # ---------------------------
 class Conversation:
+    # Formats of the display strings, generated from created_at when read
+    date_format = "%d %B %Y"
+    time_format = "%I:%M %p"
+
     def __init__(self, 
+                 created_at: Optional[datetime] = None,
                  date: Optional[date] = None,
                  time: Optional[time] = None,
                  duration: Optional[Union[int, float]] = None,
@@ -72,7 +77,10 @@ class Conversation:
         """
         Initialize a Conversation instance.
         Unprovided parameters default to None.
+        created_at is stored as a Firestore timestamp, date and time
+        are only set on documents written before it existed.
         """
+        self.created_at = created_at
         self.date = date
         self.time = time
         self.duration = duration
@@ -86,18 +94,44 @@ class Conversation:
         """ Convert the Conversation instance to a dictionary,
             only including keys with non-None values """
         return {
-            key: (self.datetimeformat(value) if isinstance(value, (date, time) ) else value)
+            key: (value if isinstance(value, datetime) 
+                  else self.datetimeformat(value) if isinstance(value, (date, time) ) else value)
             for key, value in self.__dict__.items() if value is not None
         }
 
     def datetimeformat(self, datetimeobj):
         if isinstance(datetimeobj, date):
-            return datetimeobj.strftime("%d %B %Y")
+            return datetimeobj.strftime(self.date_format)
         elif isinstance(datetimeobj, time):
-            return datetimeobj.strftime("%I:%M %p")
+            return datetimeobj.strftime(self.time_format)
         else:
             print("ERROR invalid date/time obj passed")
 
+    @classmethod
+    def display_dict(cls, data: Dict[str, Any]) -> Dict[str, Any]:
+        """ Stored conversation as sent to clients, with the date and time 
+            strings in the server's local time and created_at in ISO format """
+        new_data = {key: value for key, value in data.items()}
+        created_at = new_data.get("created_at")
+        if isinstance(created_at, datetime):
+            local = created_at.astimezone()
+            new_data["date"] = local.strftime(cls.date_format)
+            new_data["time"] = local.strftime(cls.time_format)
+            new_data["created_at"] = created_at.isoformat()
+        return new_data
+
+    @classmethod
+    def legacy_created_at(cls, data: Dict[str, Any]) -> Optional[datetime]:
+        """ Timestamp of a document written with only the date and time strings,
+            which were in the server's local time """
+        if not isinstance(data.get("date"), str):
+            return None
+        moment = datetime.strptime(data["date"], cls.date_format)
+        if isinstance(data.get("time"), str):
+            clock = datetime.strptime(data["time"], cls.time_format).time()
+            moment = datetime.combine(moment.date(), clock)
+        return moment.astimezone().astimezone(timezone.utc)
+
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> "Conversation":
         # Copy the original dictionary
@@ -127,6 +161,10 @@ class ConversationSummary:
                  stressSummary: Optional[str] = None,
                  total_duration: Optional[Union[int, float]] = None,
                  interests_summary:Optional[str] = None, 
+                 mean_duration: Optional[float] = None,
+                 emotion_histogram: Optional[Dict[str, int]] = None,
+                 stress_histogram: Optional[Dict[str, int]] = None,
+                 recent_stress: Optional[List[Dict[str, Any]]] = None,
                  ):
         """
         Initialize a Conversation instance.
@@ -139,6 +177,12 @@ class ConversationSummary:
         self.stressSummary = stressSummary
         self.conversations = conversations
         self.interests_summary = interests_summary
+        # Running aggregates, updated with increments on every conversation
+        self.mean_duration = mean_duration
+        self.emotion_histogram = emotion_histogram
+        self.stress_histogram = stress_histogram
+        # Latest {stress, reason} first, at most RECENT_STRESS_SIZE
+        self.recent_stress = recent_stress
 
     def to_dict(self) -> Dict[str, Any]:
         """ Convert the Conversation instance to a dictionary,
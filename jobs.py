@@ -0,0 +1,162 @@
+import json
+import signal
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Semaphore
+from typing import Any, Callable, Dict, Optional
+
+from config import JOB_MAX_ATTEMPTS, JOB_RESULT_TTL_SECONDS, JOB_RETRY_BACKOFF_SECONDS
+from redis_store import redis
+
+# -----------------------------------------------------------------
+# Redis layout of a queue
+#   jobs:<queue>:pending     list of job ids waiting to be picked up
+#   jobs:<queue>:processing  list of job ids currently being worked on
+#   jobs:<queue>:delayed     sorted set of job ids waiting for a retry
+#   jobs:<queue>:dead        list of job ids that ran out of attempts
+#   jobs:job:<job_id>        hash with the status, payload and result
+# -----------------------------------------------------------------
+
+def pending_key(queue: str):
+    return f"jobs:{queue}:pending"
+
+def processing_key(queue: str):
+    return f"jobs:{queue}:processing"
+
+def delayed_key(queue: str):
+    return f"jobs:{queue}:delayed"
+
+def dead_key(queue: str):
+    return f"jobs:{queue}:dead"
+
+def job_key(job_id: str):
+    return f"jobs:job:{job_id}"
+
+
+class JobFailed(Exception):
+    """ Raised by a job handler when the job did not succeed """
+
+
+# -----------------------------------------------------------------
+# Producer side
+# -----------------------------------------------------------------
+
+def enqueue_job(queue: str, payload: Dict[str, Any]):
+    """ Stores the payload and queues it. Returns the job id """
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    pipe = redis.pipeline()
+    pipe.hset(job_key(job_id), mapping={
+        "queue": queue,
+        "status": "queued",
+        "payload": json.dumps(payload),
+        "attempts": 0,
+        "created_at": now,
+        "updated_at": now,
+    })
+    pipe.lpush(pending_key(queue), job_id)
+    pipe.execute()
+    return job_id
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """ Returns the stored job or None if it does not exist (or expired) """
+    data = redis.hgetall(job_key(job_id))
+    if not data:
+        return None
+    job = {key.decode(): value.decode() for key, value in data.items()}
+    job["job_id"] = job_id
+    job["payload"] = json.loads(job["payload"])
+    job["attempts"] = int(job["attempts"])
+    if "result" in job:
+        job["result"] = json.loads(job["result"])
+    return job
+
+
+# -----------------------------------------------------------------
+# Consumer side
+# -----------------------------------------------------------------
+
+def process_job(queue: str, job_id: str, handler: Callable[[str, Dict[str, Any]], Any]):
+    """ Runs the handler on a job that was moved to the processing list
+        and settles it as done, retrying or dead. The handler gets the job id
+        too, so a retried job can recognise the writes of an earlier attempt """
+    key = job_key(job_id)
+    attempts = redis.hincrby(key, "attempts", 1)
+    redis.hset(key, mapping={"status": "running", "updated_at": time.time()})
+    payload = json.loads(redis.hget(key, "payload"))
+
+    try:
+        result = handler(job_id, payload)
+    except Exception as e:
+        pipe = redis.pipeline()
+        pipe.hset(key, mapping={"error": str(e), "updated_at": time.time()})
+        if attempts < JOB_MAX_ATTEMPTS:
+            retry_at = time.time() + JOB_RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1)
+            pipe.hset(key, "status", "retrying")
+            pipe.zadd(delayed_key(queue), {job_id: retry_at})
+            print(f"Job {job_id} failed (attempt {attempts}), retrying: {str(e)}")
+        else:
+            pipe.hset(key, "status", "failed")
+            pipe.lpush(dead_key(queue), job_id)
+            print(f"Job {job_id} failed (attempt {attempts}), moved to dead letters: {str(e)}")
+        pipe.lrem(processing_key(queue), 1, job_id)
+        pipe.execute()
+        return
+
+    pipe = redis.pipeline()
+    pipe.hset(key, mapping={"status": "done",
+                            "result": json.dumps(result),
+                            "updated_at": time.time()})
+    pipe.expire(key, JOB_RESULT_TTL_SECONDS)
+    pipe.lrem(processing_key(queue), 1, job_id)
+    pipe.execute()
+    print(f"Job {job_id} done")
+
+def promote_delayed_jobs(queue: str):
+    """ Moves retries whose backoff is over back to the pending list """
+    due = redis.zrangebyscore(delayed_key(queue), 0, time.time())
+    for job_id in due:
+        # Only the worker that removes the entry gets to requeue it
+        if redis.zrem(delayed_key(queue), job_id):
+            redis.lpush(pending_key(queue), job_id)
+
+def recover_processing_jobs(queue: str):
+    """ Requeues jobs left in the processing list by a worker that died.
+        Only safe to call when no other worker is running on the queue """
+    recovered = 0
+    while redis.rpoplpush(processing_key(queue), pending_key(queue)) is not None:
+        recovered += 1
+    return recovered
+
+def run_worker(queue: str,
+               handler: Callable[[str, Dict[str, Any]], Any],
+               concurrency: int,
+               poll_timeout: int = 1):
+    """ Processes jobs of a queue with at most `concurrency` running at once,
+        until SIGINT/SIGTERM is received """
+    stop = Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+
+    slots = Semaphore(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"{queue}-worker")
+    print(f"Worker started on queue '{queue}' with concurrency {concurrency}")
+
+    while not stop.is_set():
+        promote_delayed_jobs(queue)
+
+        # Wait for a free slot before taking a job off the queue
+        if not slots.acquire(timeout=poll_timeout):
+            continue
+        job_id = redis.blmove(pending_key(queue), processing_key(queue),
+                              poll_timeout, "RIGHT", "LEFT")
+        if job_id is None:
+            slots.release()
+            continue
+
+        future = executor.submit(process_job, queue, job_id.decode(), handler)
+        future.add_done_callback(lambda _: slots.release())
+
+    print("Worker stopping, waiting for running jobs to finish")
+    executor.shutdown(wait=True)
@@ -0,0 +1,104 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """ Thread safe in-process LRU cache bounded by item count and/or total size,
+        with an optional time to live per entry """
+
+    def __init__(self,
+                 max_items: Optional[int] = None,
+                 max_size: Optional[int] = None,
+                 ttl: Optional[float] = None,
+                 sizeof: Callable[[Any], int] = lambda value: 1):
+        self.max_items = max_items
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, key: Hashable):
+        """ Returns the cached value or None, marking it as recently used """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        size = self.sizeof(value)
+        # A value larger than the whole cache would evict everything
+        if self.max_size is not None and size > self.max_size:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, expires_at)
+            self.size += size
+            while (self.max_items is not None and len(self.entries) > self.max_items) or \
+                  (self.max_size is not None and self.size > self.max_size):
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def pop(self, key: Hashable):
+        """ Removes and returns the value of a key, or None """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self._remove(key)
+            return entry[0]
+
+    def take(self, key: Hashable, is_valid: Callable[[Any], bool] = lambda value: True):
+        """ Removes and returns the value of a key if is_valid accepts it, else None.
+            A rejected value is dropped too and counted as a miss """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._remove(key)
+            value, _, expires_at = entry
+            if (expires_at is not None and expires_at < time.monotonic()) or not is_valid(value):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return value
+
+    def keys(self):
+        """ Snapshot of the cached keys, expired ones included until looked up """
+        with self.lock:
+            return list(self.entries)
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": len(self.entries),
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,210 @@
+""" Offline maintenance commands
+
+    python manage.py <command> --help
+"""
+import argparse
+import gc
+import glob
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from config import SER_MODEL_NAME, SER_ONNX_PATH
+
+# -----------------------------------------------------------------
+# Speech emotion recognition backends
+# -----------------------------------------------------------------
+
+def export_ser_onnx(args):
+    """ Exports the SER model to an ONNX graph, optionally int8 quantized """
+    import torch
+    from transformers import AutoFeatureExtractor, AutoModelForAudioClassification
+
+    from child_api.ser_backends import SAMPLING_RATE
+
+    model = AutoModelForAudioClassification.from_pretrained(SER_MODEL_NAME).eval()
+    feature_extractor = AutoFeatureExtractor.from_pretrained(SER_MODEL_NAME)
+
+    # Two clips of different length so the padded inputs look like a real batch
+    dummy = feature_extractor([np.zeros(SAMPLING_RATE, dtype=np.float32),
+                               np.zeros(SAMPLING_RATE // 2, dtype=np.float32)],
+                              sampling_rate=SAMPLING_RATE,
+                              padding=True,
+                              return_tensors="pt")
+    input_names = list(dummy.keys())
+    dynamic_axes = {name: {0: "batch", 1: "samples"} for name in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    fp32_path = args.output + ".fp32" if args.quantize else args.output
+    with torch.no_grad():
+        torch.onnx.export(model,
+                          tuple(dummy[name] for name in input_names),
+                          fp32_path,
+                          input_names=input_names,
+                          output_names=["logits"],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=args.opset)
+    print("Exported ONNX graph to ", fp32_path)
+
+    if args.quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_path, args.output, weight_type=QuantType.QInt8)
+        os.remove(fp32_path)
+        print("Quantized ONNX graph to ", args.output)
+
+def compare_ser_backends(args):
+    """ Runs every backend on the same WAV files and reports latency and
+        how often the top label agrees with the first backend """
+    from child_api.ser_backends import load_backend
+
+    paths = sorted(glob.glob(os.path.join(args.wav_dir, "*.wav")))
+    if not paths:
+        print("No WAV files found in ", args.wav_dir)
+        return
+    clips = []
+    for path in paths:
+        with open(path, "rb") as f:
+            clips.append(f.read())
+
+    reports = {}
+    for name in args.backends:
+        load_start = time.perf_counter()
+        infer = load_backend(name)
+        load_seconds = time.perf_counter() - load_start
+
+        # Warmup so lazy initialisation does not count as latency
+        infer([clips[0]])
+
+        latencies = []
+        labels = []
+        for _ in range(args.repeat):
+            labels = []
+            for clip in clips:
+                start = time.perf_counter()
+                results = infer([clip])[0]
+                latencies.append(time.perf_counter() - start)
+                labels.append(max(results, key=lambda x: x['score'])['label'])
+
+        reports[name] = {"load_seconds": load_seconds,
+                         "latencies": np.array(latencies) * 1000,
+                         "labels": labels}
+        del infer
+        gc.collect()
+
+    baseline = reports[args.backends[0]]["labels"]
+    print(f"{len(clips)} clips x {args.repeat} runs, agreement against '{args.backends[0]}'")
+    print(f"{'backend':<12}{'load s':>9}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'agreement':>11}")
+    for name, report in reports.items():
+        latencies = report["latencies"]
+        agreement = np.mean([a == b for a, b in zip(report["labels"], baseline)])
+        print(f"{name:<12}{report['load_seconds']:>9.1f}{latencies.mean():>10.1f}"
+              f"{np.percentile(latencies, 50):>10.1f}{np.percentile(latencies, 95):>10.1f}"
+              f"{agreement:>11.1%}")
+
+
+# -----------------------------------------------------------------
+# Startup cost
+# -----------------------------------------------------------------
+
+def import_report(args):
+    """ Imports every module in a fresh interpreter with -X importtime and
+        reports its total cost and the most expensive imports under it """
+    for module in args.modules:
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                              capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+        entries = []
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            fields = line[len("import time:"):].split("|")
+            if len(fields) != 3 or not fields[0].strip().isdigit():
+                continue
+            entries.append((fields[2].strip(), int(fields[0]) / 1000, int(fields[1]) / 1000))
+
+        total = next((cumulative for name, _, cumulative in entries if name == module), None)
+        if proc.returncode != 0:
+            print(f"{module}: failed to import - {proc.stderr.strip().splitlines()[-1]}")
+        else:
+            print(f"{module}: {total:.0f} ms")
+        for name, self_ms, cumulative_ms in sorted(entries, key=lambda e: e[1], reverse=True)[:args.top]:
+            print(f"    {name:<50}{self_ms:>10.1f} ms self{cumulative_ms:>10.1f} ms cumulative")
+
+
+# -----------------------------------------------------------------
+# Firestore
+# -----------------------------------------------------------------
+
+def backfill_usernames(args):
+    """ Builds the username index and its Redis mirror from the existing children """
+    from firestore import backfill_username_index
+
+    indexed, conflicts = backfill_username_index()
+    print(f"Indexed {indexed} usernames")
+    for username in conflicts:
+        print(f"    '{username}' is used by more than one child, kept the first owner")
+
+BACKFILL_CHECKPOINT_KEY = "backfill:conversation_timestamps"
+
+def backfill_conversation_timestamps(args):
+    """ Moves every conversation from date and time strings to a created_at timestamp.
+        The last committed document is checkpointed in Redis, a rerun resumes after it """
+    from firestore import backfill_conversation_timestamps as backfill
+    from redis_store import redis
+
+    start_after = None
+    if not args.restart:
+        checkpoint = redis.get(BACKFILL_CHECKPOINT_KEY)
+        start_after = checkpoint.decode() if checkpoint else None
+        if start_after:
+            print("Resuming after ", start_after)
+
+    read, updated = 0, 0
+    for page_read, page_updated, last_path in backfill(args.batch_size, start_after):
+        read += page_read
+        updated += page_updated
+        redis.set(BACKFILL_CHECKPOINT_KEY, last_path)
+        print(f"Read {read} conversations, updated {updated}")
+    redis.delete(BACKFILL_CHECKPOINT_KEY)
+    print("Backfill complete")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Saathi maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("export-ser-onnx", help="export the SER model to ONNX")
+    command.add_argument("--output", default=SER_ONNX_PATH)
+    command.add_argument("--quantize", action="store_true", help="int8 dynamic quantization of the graph")
+    command.add_argument("--opset", type=int, default=17)
+    command.set_defaults(func=export_ser_onnx)
+
+    command = commands.add_parser("compare-ser-backends", help="compare SER backends on a WAV set")
+    command.add_argument("--wav-dir", required=True)
+    command.add_argument("--backends", nargs="+", default=["pytorch", "quantized", "onnx"],
+                         help="the first one is the reference for agreement")
+    command.add_argument("--repeat", type=int, default=3)
+    command.set_defaults(func=compare_ser_backends)
+
+    command = commands.add_parser("import-report", help="report the import time of modules")
+    command.add_argument("modules", nargs="*",
+                         default=["config", "firestore", "child_api.gemini", "child_api.helper",
+                                  "parent_api.routes", "common_api.routes", "worker", "app"])
+    command.add_argument("--top", type=int, default=10, help="most expensive imports listed per module")
+    command.set_defaults(func=import_report)
+
+    command = commands.add_parser("backfill-usernames", help="build the username index from existing children")
+    command.set_defaults(func=backfill_usernames)
+
+    command = commands.add_parser("backfill-conversation-timestamps", 
+                                  help="store a created_at timestamp on conversations saved with date/time strings")
+    command.add_argument("--batch-size", type=int, default=400, help="conversations per committed batch, at most 500")
+    command.add_argument("--restart", action="store_true", help="ignore the checkpoint of an interrupted run")
+    command.set_defaults(func=backfill_conversation_timestamps)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,143 @@
+import hashlib
+import itertools
+import re
+import time
+import unicodedata
+from threading import Lock
+from typing import Dict, FrozenSet, List, Optional, Set
+
+from config import (PARENT_ANSWER_CACHE_ENABLED, PARENT_ANSWER_CACHE_ITEMS, PARENT_ANSWER_CACHE_MAX_HISTORY_TURNS,
+                    PARENT_ANSWER_CACHE_THRESHOLD, PARENT_ANSWER_CACHE_TTL_SECONDS)
+from lru import LRUCache
+
+# ----------------------------------------------------------------------
+# Answers to parent questions asked at the start of a chat, reused for
+# questions worded almost the same way. A question is reduced to a set
+# of word shingles. A MinHash signature of that set is split into LSH
+# bands so only questions sharing a band are compared. A candidate is a
+# hit when the Jaccard similarity of the shingles reaches
+# PARENT_ANSWER_CACHE_THRESHOLD.
+# ----------------------------------------------------------------------
+
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS = NUM_PERMUTATIONS // BANDS
+MERSENNE_PRIME = (1 << 61) - 1
+
+stop_words = {"a", "an", "the", "i", "my", "me", "we", "our", "is", "are", "am", "do", "does", "can",
+              "to", "of", "for", "in", "on", "with", "and", "or", "it", "be", "should", "what", "how"}
+
+# Fixed (a, b) pairs of the universal hashes standing in for permutations
+permutations = [(int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % MERSENNE_PRIME or 1,
+                 int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % MERSENNE_PRIME)
+                for i in range(NUM_PERMUTATIONS)]
+
+# entry id -> (shingles, band keys, answer, seconds the answer took)
+entries = LRUCache(max_items=PARENT_ANSWER_CACHE_ITEMS, ttl=PARENT_ANSWER_CACHE_TTL_SECONDS)
+# band key -> entry ids, ids of evicted entries are dropped when met
+buckets: Dict[tuple, Set[int]] = {}
+buckets_lock = Lock()
+entry_ids = itertools.count()
+
+metrics = {"lookups": 0, "hits": 0, "seconds_saved": 0.0, "lookup_seconds": 0.0}
+metrics_lock = Lock()
+
+
+def normalize_question(question: str):
+    """ Lower case words without punctuation or filler words """
+    text = unicodedata.normalize("NFKC", question).lower()
+    return [word for word in re.findall(r"[a-z0-9']+", text) if word not in stop_words]
+
+def shingles(question: str) -> FrozenSet[str]:
+    """ Words and word pairs of the normalized question """
+    words = normalize_question(question)
+    return frozenset(words + [" ".join(pair) for pair in zip(words, words[1:])])
+
+def minhash(tokens: FrozenSet[str]) -> List[int]:
+    hashes = [int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "big") for token in tokens]
+    return [min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in permutations]
+
+def band_keys(signature: List[int]):
+    return [(band, tuple(signature[band * ROWS:(band + 1) * ROWS])) for band in range(BANDS)]
+
+def jaccard(first: FrozenSet[str], second: FrozenSet[str]):
+    return len(first & second) / len(first | second)
+
+def is_eligible(history_turns: int):
+    """ Only questions without much context before them have a reusable answer """
+    return PARENT_ANSWER_CACHE_ENABLED and history_turns <= PARENT_ANSWER_CACHE_MAX_HISTORY_TURNS
+
+def lookup(question: str) -> Optional[str]:
+    """ Stored answer of the most similar question above the threshold, or None """
+    start = time.perf_counter()
+    tokens = shingles(question)
+    best, best_similarity = None, 0.0
+    if tokens:
+        keys = band_keys(minhash(tokens))
+        with buckets_lock:
+            candidates = set().union(*(buckets.get(key, ()) for key in keys))
+        for entry_id in candidates:
+            entry = entries.get(entry_id)
+            if entry is None:
+                forget(entry_id, keys)
+                continue
+            similarity = jaccard(tokens, entry[0])
+            if similarity >= PARENT_ANSWER_CACHE_THRESHOLD and similarity > best_similarity:
+                best, best_similarity = entry, similarity
+
+    with metrics_lock:
+        metrics["lookups"] += 1
+        metrics["lookup_seconds"] += time.perf_counter() - start
+        if best is not None:
+            metrics["hits"] += 1
+            metrics["seconds_saved"] += best[3]
+    return best[2] if best is not None else None
+
+def store(question: str, answer: str, answer_seconds: float):
+    """ Keeps the answer of a question along with how long Gemini took for it """
+    tokens = shingles(question)
+    if not tokens:
+        return
+    keys = band_keys(minhash(tokens))
+    entry_id = next(entry_ids)
+    entries.set(entry_id, (tokens, keys, answer, answer_seconds))
+    with buckets_lock:
+        for key in keys:
+            buckets.setdefault(key, set()).add(entry_id)
+    # Evicted entries are only unlinked when a lookup meets them, sweep the rest now and then
+    if entry_id and entry_id % PARENT_ANSWER_CACHE_ITEMS == 0:
+        sweep_buckets()
+
+def forget(entry_id: int, keys):
+    """ Drops an evicted or expired entry from the buckets it was met in """
+    with buckets_lock:
+        for key in keys:
+            bucket = buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del buckets[key]
+
+def sweep_buckets():
+    """ Drops the ids of every evicted entry from the buckets """
+    live = set(entries.keys())
+    with buckets_lock:
+        for key in list(buckets):
+            buckets[key] &= live
+            if not buckets[key]:
+                del buckets[key]
+
+def get_cache_stats():
+    """ Hit rate, Gemini time saved and eviction counts of the answer cache """
+    with metrics_lock:
+        stats = dict(metrics)
+    stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else None
+    stats["mean_lookup_ms"] = stats["lookup_seconds"] / stats["lookups"] * 1000 if stats["lookups"] else None
+    entry_stats = entries.stats()
+    with buckets_lock:
+        stats["buckets"] = len(buckets)
+    return {"enabled": PARENT_ANSWER_CACHE_ENABLED,
+            "threshold": PARENT_ANSWER_CACHE_THRESHOLD,
+            "items": entry_stats["items"],
+            "evictions": entry_stats["evictions"],
+            **stats}
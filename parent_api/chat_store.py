@@ -0,0 +1,42 @@
+import json
+import uuid
+from typing import List
+
+from config import PARENT_CHAT_KEEP_TURNS, PARENT_CHAT_TRIM_SLACK_TURNS, PARENT_CHAT_TTL_SECONDS
+from redis_store import redis
+
+# -----------------------------------------------------------------
+# History of the parent text chats, so a request only carries the new
+# message. parent_chat:<id> is a list of JSON history entries, trimmed
+# back to the newest PARENT_CHAT_KEEP_TURNS turns once it holds
+# PARENT_CHAT_TRIM_SLACK_TURNS more. Trimming in steps lets the cached
+# Gemini session of the chat be reused between trims. It expires
+# PARENT_CHAT_TTL_SECONDS after the last message.
+# -----------------------------------------------------------------
+
+def history_key(conversation_id: str):
+    return f"parent_chat:{conversation_id}"
+
+def new_conversation_id():
+    return uuid.uuid4().hex
+
+def load_history(conversation_id: str) -> List[dict]:
+    return [json.loads(entry) for entry in redis.lrange(history_key(conversation_id), 0, -1)]
+
+def append_turn(conversation_id: str, message: str, reply: str) -> bool:
+    """ Appends a user message and its reply, dropping the oldest turns once 
+        over the limit. Returns whether turns were dropped """
+    pipe = redis.pipeline()
+    pipe.rpush(history_key(conversation_id),
+               json.dumps({"role": "user", "parts": message}),
+               json.dumps({"role": "model", "parts": reply}))
+    pipe.expire(history_key(conversation_id), PARENT_CHAT_TTL_SECONDS)
+    length, _ = pipe.execute()
+
+    if length <= (PARENT_CHAT_KEEP_TURNS + PARENT_CHAT_TRIM_SLACK_TURNS) * 2:
+        return False
+    redis.ltrim(history_key(conversation_id), -PARENT_CHAT_KEEP_TURNS * 2, -1)
+    return True
+
+def delete_history(conversation_id: str):
+    redis.delete(history_key(conversation_id))
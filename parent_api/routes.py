@@ -1,53 +1,131 @@
-from flask import session
+import time
+from flask import Response, session, stream_with_context
 from flask.views import MethodView
 from flask_smorest import Blueprint
-from config import GEMINI_API_KEY
-from firestore import check_username_exists, create_child_entry, delete_habitual_task, delete_learning_task, list_all_habitual_tasks, list_all_learning_tasks, update_child_entry, update_habitual_task, update_learning_task
+from firestore import create_child_entry, delete_habitual_task, delete_learning_task, list_all_habitual_tasks, list_all_learning_tasks, update_child_credentials, update_habitual_task, update_learning_task
 from firestore_schema import Child
-import google.generativeai as genai
+from child_api.gemini import drop_chat_session, keep_chat_session, start_chat_session, stream_message
+from child_api.providers import track_call
+from sse import sse_event
 
+from parent_api import answer_cache
+from parent_api.chat_store import append_turn, load_history, new_conversation_id
 from parent_api.schema import ChatSchema, ChildCreateSchema, ChildCredentialsUpdateSchma
 
 parent_bp = Blueprint('Parent API', __name__, 
                     url_prefix='/parent', 
                     description="")
 
-# Configure Google GenAI API key
-genai.configure(api_key=GEMINI_API_KEY)
-
-# Initialize the model
-model = genai.GenerativeModel( model_name="gemini-1.5-flash" )
-
 # --------------------------------------------------------------------
 # CHATBOT ROUTE
 # --------------------------------------------------------------------
 
+system_message = [
+    {
+        "role": "user", 
+        "parts": "You are an expert consultant and doctor specializing in autism spectrum disorder (ASD) named Aasha. Your role is to provide compassionate, research-backed, and practical advice to parents seeking guidance on raising and supporting their neurodivergent child. Ensure that your responses are evidence-based, empathetic, and easy to understand. Limit to 200 words. Do not answer out of questions unrealted to advice regarding physchology." },
+]
+
+def load_chat(conversation_id: str | None):
+    """ (conversation id, history with the system message) of the chat a message belongs to """
+    if not conversation_id:
+        return new_conversation_id(), list(system_message)
+    return conversation_id, system_message + load_history(conversation_id)
+
+def history_turns(full_history: list):
+    return (len(full_history) - len(system_message)) // 2
+
+def session_cache_key(conversation_id: str):
+    # Shares the Gemini session cache with the voice chats
+    return "parent:" + conversation_id
+
+def save_turn(conversation_id: str, chat_session, full_history: list, msg: str, reply: str):
+    """ Stores the turn and keeps the Gemini session for the next one. A session 
+        holding turns the store just trimmed away is dropped, the next turn 
+        rebuilds it from the trimmed history """
+    if append_turn(conversation_id, msg, reply):
+        drop_chat_session(session_cache_key(conversation_id))
+    else:
+        keep_chat_session(session_cache_key(conversation_id), chat_session, full_history, msg, reply)
+
 @parent_bp.route("/text_chat")
 class ChatRoute(MethodView):
     # POST REQUEST 
     @parent_bp.response(status_code=201)
     @parent_bp.arguments(ChatSchema)
     def post(self, params):
-        '''Text to Text Gemini Request Endpoint'''
-        msg = params.get('chat','')
-        chat_history = params.get('history', [])
-
-        system_message = [
-            {
-                "role": "user", 
-                "parts": "You are an expert consultant and doctor specializing in autism spectrum disorder (ASD) named Aasha. Your role is to provide compassionate, research-backed, and practical advice to parents seeking guidance on raising and supporting their neurodivergent child. Ensure that your responses are evidence-based, empathetic, and easy to understand. Limit to 200 words. Do not answer out of questions unrealted to advice regarding physchology." },
-        ]
-
-        full_history = system_message + chat_history
-        chat_session = model.start_chat(history=full_history)
+        '''Text to Text Gemini Request Endpoint. Send the returned conversation_id 
+        with the next message to continue the conversation'''
+        msg = params['chat']
+        conversation_id, full_history = load_chat(params.get('conversation_id'))
+
+        # Opening questions asked before in other words reuse the stored answer
+        cacheable = answer_cache.is_eligible(history_turns(full_history))
+        cached_answer = answer_cache.lookup(msg) if cacheable else None
+        if cached_answer is not None:
+            append_turn(conversation_id, msg, cached_answer)
+            return {"text":cached_answer, "conversation_id": conversation_id}
 
         try:
-            response = chat_session.send_message(msg)
+            start = time.perf_counter()
+            chat_session = start_chat_session(full_history, session_cache_key(conversation_id))
+            with track_call("gemini"):
+                response = chat_session.send_message(msg)
             print(response.text)
-            return {"text":response.text}
         except Exception as e:
             return {"error" : str(e)}, 500
 
+        if cacheable:
+            answer_cache.store(msg, response.text, time.perf_counter() - start)
+        save_turn(conversation_id, chat_session, full_history, msg, response.text)
+        return {"text":response.text, "conversation_id": conversation_id}
+
+@parent_bp.route("/text_chat_stream")
+class ChatStreamRoute(MethodView):
+    # POST REQUEST 
+    @parent_bp.response(status_code=200)
+    @parent_bp.arguments(ChatSchema)
+    def post(self, params):
+        '''Text to Text Gemini Request Endpoint streaming the reply as server sent events.
+        Every `chunk` event holds the next part of the reply, `done` holds the full reply 
+        and the conversation_id to send with the next message'''
+        msg = params['chat']
+        conversation_id, full_history = load_chat(params.get('conversation_id'))
+        cacheable = answer_cache.is_eligible(history_turns(full_history))
+
+        def generate():
+            # Opening questions asked before in other words reuse the stored answer
+            cached_answer = answer_cache.lookup(msg) if cacheable else None
+            if cached_answer is not None:
+                append_turn(conversation_id, msg, cached_answer)
+                yield sse_event("chunk", {"text": cached_answer})
+                yield sse_event("done", {"text": cached_answer, "conversation_id": conversation_id})
+                return
+
+            reply_chunks = []
+            start = time.perf_counter()
+            try:
+                chat_session = start_chat_session(full_history, session_cache_key(conversation_id))
+                # Recorded apart from the voice chat streams of the child routes
+                for text in stream_message(chat_session, msg, "parent_gemini_stream"):
+                    reply_chunks.append(text)
+                    yield sse_event("chunk", {"text": text})
+            except Exception as e:
+                yield sse_event("error", {"error": str(e)})
+                return
+
+            reply = "".join(reply_chunks)
+            if cacheable:
+                answer_cache.store(msg, reply, time.perf_counter() - start)
+            save_turn(conversation_id, chat_session, full_history, msg, reply)
+            yield sse_event("done", {"text": reply, "conversation_id": conversation_id})
+
+        return Response(stream_with_context(generate()),
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache",
+                                 "X-Accel-Buffering": "no",
+                                 "X-Conversation-Id": conversation_id})
+
 
 # --------------------------------------------------------------------
 # Firestore route
@@ -84,12 +162,6 @@ class ChildCredPUT(MethodView):
     @parent_bp.arguments(schema=ChildCredentialsUpdateSchma)
     def put(self, params):
         ''' Update the username and password for a child user'''
-        # Check if username exists
-        if check_username_exists(params['username']):
-            return { "status":400, "message":"Username exists already"}
-
-        # Create a child object to verify params
-        child: Child = Child.from_dict(params)
         child_id = session.get('child_id', None)  
 
         # Child not found
@@ -97,42 +169,21 @@ class ChildCredPUT(MethodView):
             return {"status":400,
                     "message": "Child_ID not found" }, 400
 
-        # Update Child Entry
-        status = update_child_entry(child_id, child) 
+        # Claims the username and updates the credentials in one transaction,
+        # fails if another child has the username
+        updated, status = update_child_credentials(child_id, params['username'], params['password'])
+        if not updated:
+            return { "status":400, "message":status}
         return { "status": 200 , "message" : status }
 
 
 # --------------------------------------------------------------------
-# Depreciated routes
+# DEV ONLY Routes
 # --------------------------------------------------------------------
 
-# We are not using the below function in the current version.
-# @app.route("/stream", methods=["POST"])
-# def stream():
-#     """Streams AI responses for real-time chat interactions.
-#
-#     This function initiates a streaming session with the Gemini AI model,
-#     continuously sending user inputs and streaming back the responses. It handles
-#     POST requests to the '/stream' endpoint with a JSON payload similar to the
-#     '/chat' endpoint.
-#
-#     Args:
-#         None (uses Flask `request` object to access POST data)
-#
-#     Returns:
-#         A Flask `Response` object that streams the AI-generated responses.
-#     """
-#     def generate():
-#         data = request.json
-#         msg = data.get('chat','')
-#         chat_history = data.get('history',[])
-#
-#         chat_session = model.start_chat(history=chat_history)
-#         response = chat_session.send_message(msg,stream=True)
-#
-#         for chunk in response:
-#             yield f"{chunk.txt}"
-#
-#         return Response(stream_with_context(generate()), mimetype="text/event-stream")
-#     
-#
+@parent_bp.route("/answer_cache_stats")
+class AnswerCacheStats(MethodView):
+    @parent_bp.response(status_code=200)
+    def get(self):
+        '''hit rate and Gemini time saved by the near-duplicate question cache'''
+        return {"status":200, "answer_cache": answer_cache.get_cache_stats()}
@@ -1,14 +1,10 @@
 from marshmallow import Schema, fields
 
-# Object to be sent inside the history
-class HistorySchema(Schema):
-    role = fields.Str(required=True)
-    parts = fields.Str(required=True)
-
-# Chat Request Schema 
+# Chat Request Schema, the history is kept server side under the conversation id.
+# Without a conversation id a new conversation is started
 class ChatSchema(Schema):
-    history = fields.List(fields.Nested(HistorySchema), required=True)
-    chat = fields.Str()
+    chat = fields.Str(required=True)
+    conversation_id = fields.Str(missing=None)
 
 # ---------------------------
 # Schemas for /parent/child_create
@@ -0,0 +1,6 @@
+from redis import Redis
+
+from config import REDIS_SERVER_HOST, REDIS_SERVER_PORT
+
+# Shared by the session interface, the job queue and the worker
+redis = Redis(host=REDIS_SERVER_HOST, port=REDIS_SERVER_PORT)
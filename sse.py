@@ -0,0 +1,9 @@
+import json
+
+# ----------------------------------------------------------------------
+# Server sent events of the streaming chat routes
+# ----------------------------------------------------------------------
+
+def sse_event(event: str, data: dict):
+    """ Formats a server sent event """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
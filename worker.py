@@ -0,0 +1,41 @@
+""" Entry point for the background worker processing end of chat jobs
+
+    python worker.py [--concurrency N] [--recover]
+"""
+import argparse
+from datetime import datetime
+
+from config import END_CHAT_QUEUE, END_CHAT_WORKER_CONCURRENCY
+from firestore import add_new_conversation
+from jobs import JobFailed, recover_processing_jobs, run_worker
+
+
+def process_end_chat(job_id, payload):
+    """ Saves the snapshot of a finished chat as a new conversation, 
+        the job id is the conversation id so retries never save it twice """
+    # Jobs queued before ended_at was added are dated when processed
+    ended_at = datetime.fromisoformat(payload['ended_at']) if payload.get('ended_at') else None
+    status, mssg = add_new_conversation(payload['child_id'],
+                                        payload['chat_history'],
+                                        payload['emotion'],
+                                        payload['duration'],
+                                        conversation_id=job_id,
+                                        created_at=ended_at)
+    if status == False:
+        raise JobFailed(mssg)
+    return mssg
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process queued end of chat jobs")
+    parser.add_argument("--concurrency", type=int, default=END_CHAT_WORKER_CONCURRENCY,
+                        help="maximum number of jobs processed at once")
+    parser.add_argument("--recover", action="store_true",
+                        help="requeue jobs left in processing by a crashed worker. "
+                             "Only use when no other worker is running")
+    args = parser.parse_args()
+
+    if args.recover:
+        print("Recovered jobs: ", recover_processing_jobs(END_CHAT_QUEUE))
+
+    run_worker(END_CHAT_QUEUE, process_end_chat, args.concurrency)